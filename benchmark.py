@@ -0,0 +1,319 @@
+"""Benchmarks for the time travel debugger.
+
+Usage: python benchmark.py [benchmark ...] [--size N]
+
+Without arguments all benchmarks are run.
+"""
+import argparse
+import asyncio
+import random
+import sys
+import textwrap
+import time
+import tracemalloc
+
+from main import remove_html_markup
+from time_travel_debugger.domain.debugger import TimeTravelDebugger
+from time_travel_debugger.domain.searchengine import SearchEngine
+from time_travel_debugger.domain.tracer import TimeTravelTracer
+
+
+def html_input(size):
+    """ Build an html string of roughly the given size in bytes """
+    chunk = '<tag attr="value">hello</tag> world '
+    return (chunk * (size // len(chunk) + 1))[:size]
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def record(func, *args, **tracer_options):
+    tracer = TimeTravelTracer(**tracer_options)
+    tracer.set_trace()
+    func(*args)
+    return tracer.get_trace()
+
+
+def bench_record(size):
+    """ Record remove_html_markup over an input of the given size """
+    s = html_input(size)
+    untraced = timed(remove_html_markup, s)
+
+    start = time.perf_counter()
+    diffs, _ = record(remove_html_markup, s)
+    traced = time.perf_counter() - start
+
+    print(f"input size:       {size} bytes")
+    print(f"recorded steps:   {len(diffs)}")
+    print(f"untraced:         {untraced:.3f}s")
+    print(f"recording:        {traced:.3f}s")
+    print(f"steps per second: {len(diffs) / traced:.0f}")
+    print(f"overhead:         {traced / untraced:.0f}x")
+
+    # sampling mode, recording the variables of every 100th line only
+    start = time.perf_counter()
+    record(remove_html_markup, s, sample_every=100)
+    sampled = time.perf_counter() - start
+    print(f"sampled (1/100):  {sampled:.3f}s")
+    print(f"overhead:         {sampled / untraced:.0f}x")
+
+
+def wrap_text(s):
+    """ Remove the markup of an html string and wrap the text to lines """
+    return textwrap.wrap(remove_html_markup(s), 40)
+
+
+def bench_scope(size):
+    """Record wrap_text, which spends a lot of its time in textwrap, with and
+    without recording the standard library"""
+    s = html_input(size)
+    for name, options in (
+        ("everything:", {}),
+        ("main only:", {"include": ["main", "__main__"]}),
+    ):
+        start = time.perf_counter()
+        diffs, _ = record(wrap_text, s, **options)
+        elapsed = time.perf_counter() - start
+        print(f"{name:17} {elapsed:.3f}s, {len(diffs)} steps")
+
+
+def count_primes(n):
+    """ Count the primes below n, a cpu heavy loop """
+    count = 0
+    for i in range(2, n):
+        for j in range(2, int(i ** 0.5) + 1):
+            if i % j == 0:
+                break
+        else:
+            count += 1
+    return count
+
+
+async def strip_chunk(chunk):
+    """ Remove the markup of a chunk, yielding to the other tasks first """
+    await asyncio.sleep(0)
+    return remove_html_markup(chunk)
+
+
+async def strip_chunks(s):
+    chunks = [s[i : i + 1024] for i in range(0, len(s), 1024)]
+    return await asyncio.gather(*(strip_chunk(chunk) for chunk in chunks))
+
+
+def strip_concurrently(s):
+    """ Remove the markup of an html string in chunks by concurrent tasks """
+    return asyncio.run(strip_chunks(s))
+
+
+def bench_backends(size):
+    """Compare recording with settrace and sys.monitoring, which falls back
+    to settrace before python 3.12"""
+    for name, func, arg, options in (
+        ("remove_html_markup", remove_html_markup, html_input(size), {}),
+        ("count_primes", count_primes, size // 2, {}),
+        # resumed coroutines are reported differently by both, the event loop
+        # itself is not recorded
+        (
+            "strip_concurrently",
+            strip_concurrently,
+            html_input(size // 4),
+            {"include": ["main", "__main__"]},
+        ),
+    ):
+        untraced = timed(func, arg)
+        print(f"{name}, untraced: {untraced:.3f}s")
+        for backend in ("settrace", "monitoring"):
+            start = time.perf_counter()
+            diffs, _ = record(func, arg, backend=backend, **options)
+            elapsed = time.perf_counter() - start
+            print(
+                f"{backend + ':':17} {elapsed:.3f}s, {len(diffs)} steps, "
+                f"{len(diffs) / elapsed:.0f} steps per second"
+            )
+
+
+def bench_trace_memory(size):
+    """Compare the memory used by list and columnar traces. The first input
+    only consists of tags, so the recorded values are small and we mostly
+    measure the trace structure itself. wrap_text records textwrap as well,
+    with more locals, larger values and nested calls."""
+    tag = '<tag attr="value">'
+    for workload, func, arg in (
+        (
+            "remove_html_markup, tags only",
+            remove_html_markup,
+            tag * (size // len(tag)),
+        ),
+        ("wrap_text", wrap_text, html_input(size // 10)),
+    ):
+        print(f"{workload}:")
+        for name, options in (("list", {}), ("columnar", {"columnar": True})):
+            tracemalloc.start()
+            diffs, _ = record(func, arg, **options)
+            used = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            print(f"{name + ':':17} {used / len(diffs):.0f} bytes per step")
+            del diffs
+
+
+def debugger(diffs, source_map):
+    debugger = TimeTravelDebugger(
+        diffs, source_map, lambda state: None, SearchEngine()
+    )
+    debugger.start_debugger()
+    return debugger
+
+
+def bench_seek(size):
+    """ Jump to random exec points like dragging the timeline slider """
+    diffs, source_map = record(remove_html_markup, html_input(size))
+    tt_debugger = debugger(diffs, source_map)
+    random.seed(0)
+    targets = [random.randrange(len(diffs)) for _ in range(100)]
+
+    print(f"recorded steps:   {len(diffs)}")
+    # the first round also creates the checkpoints on the way
+    for round in ("first round", "second round"):
+        start = time.perf_counter()
+        for target in targets:
+            tt_debugger.step_to_index(target, ignore_breakpoints=True)
+        elapsed = time.perf_counter() - start
+        print(f"{round + ':':17} {elapsed / len(targets) * 1000:.2f}ms per jump")
+
+
+def bench_continue(size):
+    """Run continue_ from the start to the end of the trace without any
+    breakpoints, so every step of the trace is replayed once. An input of
+    200 kB records about 1M steps."""
+    diffs, source_map = record(remove_html_markup, html_input(size))
+    tt_debugger = debugger(diffs, source_map)
+
+    start = time.perf_counter()
+    tt_debugger.continue_()
+    elapsed = time.perf_counter() - start
+
+    print(f"recorded steps:   {len(diffs)}")
+    print(f"continue:         {elapsed:.3f}s")
+    print(f"steps per second: {len(diffs) / elapsed:.0f}")
+
+
+def bench_conditions(size):
+    """Run continue_ over the whole trace with 50 conditional breakpoints on
+    the lines of the loop, whose conditions are never true"""
+    diffs, source_map = record(remove_html_markup, html_input(size))
+    tt_debugger = debugger(diffs, source_map)
+    lines = (22, 24, 26, 28)
+    for i in range(50):
+        tt_debugger.add_breakpoint(
+            lineno=lines[i % len(lines)], cond=f"c == '{i:02}'"
+        )
+
+    start = time.perf_counter()
+    tt_debugger.continue_()
+    elapsed = time.perf_counter() - start
+
+    print(f"recorded steps:   {len(diffs)}")
+    print(f"continue:         {elapsed:.3f}s")
+    print(f"steps per second: {len(diffs) / elapsed:.0f}")
+
+
+def bench_breakpoints(size):
+    """Jump between the hits of a breakpoint on the return of
+    remove_html_markup, which is only hit once at the end of the trace"""
+    diffs, source_map = record(remove_html_markup, html_input(size))
+    tt_debugger = debugger(diffs, source_map)
+    tt_debugger.add_breakpoint(lineno=30)
+
+    print(f"recorded steps:   {len(diffs)}")
+    # the first continue also builds the line index and the checkpoints
+    for name, command in (
+        ("first continue", tt_debugger.continue_),
+        ("reverse", tt_debugger.reverse),
+        ("continue", tt_debugger.continue_),
+    ):
+        start = time.perf_counter()
+        command()
+        elapsed = time.perf_counter() - start
+        print(f"{name + ':':17} {elapsed * 1000:.1f}ms")
+
+
+def bench_search(size):
+    """Run a few queries, stepping between them like a user would. The first
+    search also records the events of the trace."""
+    diffs, source_map = record(remove_html_markup, html_input(size))
+    tt_debugger = debugger(diffs, source_map)
+
+    print(f"recorded steps:   {len(diffs)}")
+    for query in (
+        "out -line 29",
+        "out -line 29",
+        "c -if c == '<'",
+        "-if len(out) > 100 -line 22:28",
+        "-step 1000:2000 -depth 0",
+    ):
+        # results are lazy, so time the first page and the count separately
+        start = time.perf_counter()
+        events = tt_debugger.search("var", query)
+        events.page(0, 20)
+        first_page = time.perf_counter() - start
+        count = len(events)
+        elapsed = time.perf_counter() - start
+        print(
+            f"{query!r:32} {first_page * 1000:7.1f}ms first page, "
+            f"{elapsed * 1000:7.1f}ms all {count} events"
+        )
+        tt_debugger.step_forward()
+
+    # when did out become the first half of the output, and where was tag
+    # set last before the middle of the trace
+    out = remove_html_markup(html_input(size))
+    tt_debugger.step_to_index(len(diffs) // 2, ignore_breakpoints=True)
+    for name, lookup in (
+        ("first change to", lambda: tt_debugger.first_change_to(
+            "out", out[:len(out) // 2])),
+        ("last change", lambda: tt_debugger.last_change("tag")),
+    ):
+        start = time.perf_counter()
+        event = lookup()
+        elapsed = time.perf_counter() - start
+        print(f"{name + ':':17} {elapsed * 1000:.2f}ms, at {event.exec_point}")
+
+
+BENCHMARKS = {
+    "record": bench_record,
+    "scope": bench_scope,
+    "backends": bench_backends,
+    "memory": bench_trace_memory,
+    "seek": bench_seek,
+    "continue": bench_continue,
+    "conditions": bench_conditions,
+    "breakpoints": bench_breakpoints,
+    "search": bench_search,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("benchmarks", nargs="*", help=", ".join(BENCHMARKS))
+    parser.add_argument(
+        "--size",
+        type=int,
+        default=1024 * 1024,
+        help="input size in bytes (default: 1 MB)",
+    )
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark {name!r}")
+
+    for name in args.benchmarks or BENCHMARKS:
+        print(f"### {name}")
+        BENCHMARKS[name](args.size)
+        print()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
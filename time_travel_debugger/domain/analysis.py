@@ -0,0 +1,147 @@
+import functools
+from concurrent.futures import ProcessPoolExecutor
+
+from ..model.exec_state_diff import Action
+from ..model.trace_file import load_trace
+from .debugger import TimeTravelDebugger
+from .searchengine import SearchEngine
+
+
+class TraceAnalysis(object):
+    """Navigates a recorded trace and inspects its state without a user
+    interface, for scripts and batch jobs. All commands of the debugger
+    (next, finish, until, search, ...) are available through debugger, they
+    update no UI and evaluate no watchpoints."""
+
+    def __init__(self, diffs, source_map, threads=None):
+        self._diffs = diffs
+        self._debugger = TimeTravelDebugger(
+            diffs, source_map, None, SearchEngine(), threads
+        )
+        self._debugger.start_debugger()
+
+    @classmethod
+    def open(cls, path, trusted=False):
+        """Analyze a trace that was saved to a trace file. Only trusted files
+        can contain values of any class, since loading them can run any
+        code, see MappedTrace."""
+        return cls(*load_trace(path, trusted))
+
+    def close(self):
+        """ Close the trace file the trace was opened from, if any """
+        close = getattr(self._diffs, "close", None)
+        if close is not None:
+            close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self._diffs)
+
+    @property
+    def debugger(self):
+        return self._debugger
+
+    @property
+    def exec_point(self):
+        return self._debugger.exec_point
+
+    @property
+    def diff(self):
+        return self._debugger.curr_diff
+
+    @property
+    def state(self):
+        """ the variables of the current function """
+        return dict(self._debugger.curr_state)
+
+    @property
+    def stack(self):
+        """The call stack at the current exec point as (function name, file
+        name, line number) tuples, the outermost function first"""
+        return [
+            (state.func_name, state.file_name, state.lineno)
+            for state in self._debugger.curr_diff.get_function_states()
+        ]
+
+    @property
+    def scopes(self):
+        """ the variables of all active functions, the outermost first """
+        return self._debugger._state_machine.curr_scopes
+
+    def goto(self, exec_point):
+        """ Go to the given exec point and return self """
+        self._debugger.goto(exec_point)
+        return self
+
+    def state_at(self, exec_point):
+        """ Return the variables of the current function at the exec point """
+        return self.goto(exec_point).state
+
+    @property
+    def exception_points(self):
+        """ the exec points of all exceptions, in the order they happened """
+        return self._debugger.exception_points
+
+    def failure_point(self):
+        """Return the exec point at which the last exception was raised, or
+        None if there was none. The exception is recorded again in every
+        function it passes through, the first of them is where it was
+        raised."""
+        diffs = self._diffs
+        exception_points = self._debugger.exception_points
+        if not exception_points:
+            return None
+        exec_point = exception_points[-1]
+        for prev in reversed(exception_points[:-1]):
+            # the function the exception was raised in returned right after
+            # it, and the exception was recorded again in its caller
+            if not (
+                exec_point - prev <= 3
+                and diffs[exec_point - 1].action == Action.RET
+                and diffs[prev].depth == diffs[exec_point].depth + 1
+            ):
+                break
+            exec_point = prev
+        return exec_point
+
+    def failure(self):
+        """Return the state at which the last exception was raised as dict of
+        its exec point, traceback, call stack and the variables of all active
+        functions, or None if there was no exception"""
+        exec_point = self.failure_point()
+        if exec_point is None:
+            return None
+        self.goto(exec_point)
+        return {
+            "exec_point": exec_point,
+            "traceback": self.diff.tb,
+            "stack": self.stack,
+            "scopes": self.scopes,
+        }
+
+
+def _analyze_file(analysis, trusted, path):
+    with TraceAnalysis.open(path, trusted) as trace_analysis:
+        return analysis(trace_analysis)
+
+
+def analyze(paths, analysis, processes=None, chunksize=1, trusted=False):
+    """Call analysis with the TraceAnalysis of each of the trace files in
+    worker processes, and return the results in the order of the paths.
+    analysis and its results are sent between the processes, so they have
+    to be picklable, e.g. a function defined at module level or
+    TraceAnalysis.failure. Set trusted only if all files are trusted, see
+    TraceAnalysis.open."""
+    with ProcessPoolExecutor(processes) as executor:
+        return list(
+            executor.map(
+                functools.partial(_analyze_file, analysis, trusted),
+                paths,
+                chunksize=chunksize,
+            )
+        )
@@ -1,12 +1,13 @@
 import sys
+from array import array
+from bisect import bisect_left, bisect_right
 from enum import Enum
 from typing import List
 from functools import wraps
-from ..model.watchpoint import Watchpoint
+from ..model.watchpoint import Watchpoint, values_differ
 from ..model.breakpoint import Breakpoint, FunctionBreakpoint, BPType
 from ..model.exec_state_diff import ExecStateDiff, Action
 from ..model.event import EventType, Event
-from copy import deepcopy
 
 
 class Direction(Enum):
@@ -18,102 +19,109 @@ class Direction(Enum):
 class FunctionStates(object):
     """Helper class for managing the absolut states of functions"""
 
-    def __init__(self):
-        # maps functions to list of stored scopes
-        self._func_scopes = {}
-        #  maps the function name to the current number
-        #  of 'open' iterations for that function
-        self._func_pointers = {}
+    def __init__(self, scopes=None, remember_returns=True):
+        # stack of the scopes of all currently active functions
+        self._scopes = [scope.copy() for scope in scopes or []]
+        # scopes of the functions we returned from, so we can restore them
+        # when stepping backwards
+        self._returned_scopes = []
+        self._remember_returns = remember_returns
 
     def __str__(self):
         res = ""
-        for k, v in self._func_scopes.items():
-            res += f"\t{k}: {v} \n"
+        for depth, scope in enumerate(self._scopes):
+            res += f"\t{depth}: {scope} \n"
         return res
 
     __repr__ = __str__
 
     def __getitem__(self, func_name):
-        func_pointer = self._func_pointers[func_name]
-        #  print(f"func_pointer:{func_pointer}")
-        res = self._func_scopes[func_name][func_pointer]
-        #  print(f"found item:{res}")
-        return res
+        """ return the scope of the currently executed function """
+        try:
+            return self._scopes[-1]
+        except IndexError:
+            return {}
+
+    def checkpoint(self):
+        """Return a copy of the scopes of the active functions, which can be
+        used to create an equal FunctionStates object later on"""
+        return [scope.copy() for scope in self._scopes]
+
+    def apply(self, diff):
+        """ compute the scopes after the given diff """
+        # recorded diffs are never modified, so we can use them without
+        # copying them
+        if diff.action == Action.CALL:
+            self.call(diff.func_name, diff.changed)
+        elif diff.action == Action.RET:
+            self.ret(diff.func_name)
+        elif diff.action == Action.UPDATE:
+            self.update(diff.func_name, diff.changed)
+        elif diff.action in (Action.EXCEPTION, Action.LINE):
+            # unsampled lines keep the state of the last sampled line
+            pass
+        else:
+            raise ValueError(f"Invalid Action: '{diff.action}'")
 
     def call(self, func_name, params):
         """Stores a new scope with its parameters after the call for a function"""
         #  print(f"CALL: {func_name} - params:{params}")
-        try:
-            #  check if functions scope already exists in map
-            self._func_scopes[func_name]
-        except KeyError:
-            # if not create it
-            self._func_scopes[func_name] = [{}]
-        # then append the parameters to it as a new scope
-        self._func_scopes[func_name].append(params.copy())
-        try:
-            self._func_pointers[func_name] += 1
-        except KeyError:
-            self._func_pointers[func_name] = 1
+        self._scopes.append(params.copy())
 
     def ret(self, func_name):
-        """ this function does nothing """
+        """ leave the scope of the current function """
         #  print(f"RETURN: {func_name}")
-        pass
+        scope = self._scopes.pop()
+        if self._remember_returns:
+            self._returned_scopes.append(scope)
 
     def update(self, func_name, changes):
         """update variables of the current scope for a function"""
         #  print(f"UPDATE {func_name} - changes:{changes}")
-        self._func_scopes[func_name][-1].update(changes.copy())
+        self._scopes[-1].update(changes)
 
     def revert_call(self, func_name):
         """revert a call by deleting the most recent scope of the function"""
         #  print(f"REVERT_CALL: {func_name}")
-        self._func_pointers[func_name] -= 1
-        self._func_scopes[func_name].pop()
+        self._scopes.pop()
+
+    def can_revert_ret(self):
+        """ check if we remember the scope of the last returned function """
+        return len(self._returned_scopes) > 0
 
     def revert_ret(self, func_name):
-        """ this function does nothing """
+        """ reenter the scope of the function we returned from last """
         #  print(f"REVERT_RETURN: {func_name}")
-        # returned from function previously, so go to absolute state
-        # one scope higher (which exists, since we rewind in history,
-        # so we have created this scope in a previous execution)
-        #  self._func_pointers[func_name] += 1
-        pass
+        self._scopes.append(self._returned_scopes.pop())
 
     def revert_update(self, func_name, added, updated):
         """ revert added and updated variables from previous line in function """
         #  print(f"REVERT_UPDATE: {func_name} - added:{added} - updated:{updated}")
-        # if previous action was return then step to return statement
-        # ,since we dont want to step back to the point after
-        # the function execution
-
-        #  if self.curr_diff.action == Action.RET:
-        #  self._exec_point -= 1
-        #  self._curr_state_ptr += 1
-        #  prev_diff = deepcopy(self.curr_diff)
-        current_scope = self._func_pointers[func_name]
-        #  print(f"current_scope of {func_name}:{current_scope}")
+        current_scope = self._scopes[-1]
         before_update = {key: value.before for (key, value) in updated.items()}
         # revert updates
-        self._func_scopes[func_name][-1].update(before_update)
+        current_scope.update(before_update)
         # and delete added vars
         for k in added:
-            try:
-                self._func_scopes[func_name][current_scope].pop(k)
-            except:
-                pass
+            current_scope.pop(k, None)
 
 
 class StateMachine(object):
     """Contains the absolute state of all defined variables of all currently
     active functions"""
 
-    def __init__(self, diffs):
+    # minimal distance between two checkpoints
+    MIN_CHECKPOINT_INTERVAL = 100
+
+    def __init__(self, diffs, checkpoint_interval=None, clocks=None):
         # the diffs we computed in the tracer
         self._exec_state_diffs = diffs
-        # the function state manager
-        self._func_states = FunctionStates()
+        # logical time of each diff if the diffs are the ones of a thread,
+        # which orders them with the diffs of the other threads
+        self._clocks = clocks
+        # the function state manager, a trace of a flight recorder starts
+        # with the scopes its first step is in
+        self._func_states = FunctionStates(getattr(diffs, "base", None))
         #  start at -1 and step into first diff in start_debugger
         self._exec_point = 0
         # True if we are at the start of the current frame
@@ -121,36 +129,62 @@ class StateMachine(object):
         # True if we are the end of the current frame
         self._at_end = False
         self._direction = Direction.FORWARD
-        # to remember where we performed search last time, so we don't compute
-        # it unnessecary often
-        self._last_search_exec_point = -1
+        # every checkpoint_interval steps we store the state of all function
+        # scopes, so we can jump to any exec point by restoring the nearest
+        # checkpoint and replaying at most checkpoint_interval diffs.
+        # Default is the square root of the trace length.
+        self._checkpoint_interval = checkpoint_interval or max(
+            self.MIN_CHECKPOINT_INTERVAL, int(len(diffs) ** 0.5)
+        )
+        # the i-th checkpoint holds the state at exec point
+        # i * checkpoint_interval
+        self._checkpoints = [self._func_states.checkpoint()]
+        # exec points of exceptions, computed on first use
+        self._exception_points = None
+        # exec points of each (file name, line number), computed on first use
+        self._line_index = None
+        # exec points of each asyncio task, computed on first use
+        self._task_index = None
+
+    def _apply(self, diff):
+        """ compute the state of function scopes after the given diff """
+        self._func_states.apply(diff)
+
+        # store a checkpoint whenever we pass the next one for the first time
+        interval = self._checkpoint_interval
+        if (
+            self._exec_point % interval == 0
+            and self._exec_point // interval == len(self._checkpoints)
+        ):
+            self._checkpoints.append(self._func_states.checkpoint())
+
+    def _revert(self, diff):
+        """ compute the state of function scopes before the given diff """
+        if diff.action == Action.CALL:
+            self._func_states.revert_call(diff.func_name)
+        elif diff.action == Action.RET:
+            self._func_states.revert_ret(diff.func_name)
+        elif diff.action == Action.UPDATE:
+            self._func_states.revert_update(
+                diff.func_name, diff.added, diff.updated
+            )
+        elif diff.action in (Action.EXCEPTION, Action.LINE):
+            pass
+        else:
+            raise Exception(f"Invalid Action: '{diff.action}'")
 
     def forward(self):
         """steps one step forward if possible and computes the current state"""
         self._direction = Direction.FORWARD
         if not self.at_end:
             # step one step forward
-            prev_diff = deepcopy(self.curr_diff)
             self._exec_point += 1
-            new_diff = deepcopy(self.curr_diff)
-            # compute state of function scopes
-            if new_diff.action == Action.CALL:
-                params = new_diff.changed
-                self._func_states.call(new_diff.func_name, params)
-            elif new_diff.action == Action.RET:
-                self._func_states.ret(new_diff.func_name)
-            elif new_diff.action == Action.UPDATE:
-                self._func_states.update(
-                    new_diff.func_name, new_diff.changed.copy()
-                )
-            elif new_diff.action == Action.EXCEPTION:
-                pass
-            else:
-                raise ValueError(f"Invalid Action: '{new_diff.action}'")
+            self._apply(self.curr_diff)
 
             if self.next_action == Action.RET:
                 # skip the implicit return statement
                 self._exec_point += 1
+                self._apply(self.curr_diff)
             #  print(self._func_states)
 
     def backward(self):
@@ -160,32 +194,215 @@ class StateMachine(object):
         # Check whether we reached the start of the program
         if not self.at_start:
 
-            prev_diff = deepcopy(self.curr_diff)
-            # step one step backwards
-            self._exec_point -= 1
-            new_diff = deepcopy(self.curr_diff)
-            # compute state of function scopes
-            if prev_diff.action == Action.CALL:
-                self._func_states.revert_call(prev_diff.func_name)
-            elif prev_diff.action == Action.RET:
-                self._func_states.revert_ret(new_diff.func_name)
-            elif prev_diff.action == Action.UPDATE:
-                self._func_states.revert_update(
-                    new_diff.func_name,
-                    prev_diff.added.copy(),
-                    prev_diff.updated.copy(),
-                )
-            elif prev_diff.action == Action.EXCEPTION:
-                pass
-            else:
-                raise Exception(f"Invalid Action: '{prev_diff.action}'")
-
+            prev_diff = self.curr_diff
+            target = self._exec_point - 1
             if prev_diff.action == Action.RET:
                 # skip the implicit return statement and the line of callee
+                target -= 1
+                if not self._func_states.can_revert_ret():
+                    # we came here from a checkpoint, so we don't know the
+                    # scope of the callee
+                    self.seek(target)
+                    return
+
+            while self._exec_point > target:
+                self._revert(self.curr_diff)
                 self._exec_point -= 1
 
             #  print(self._func_states)
 
+    def seek(self, exec_point):
+        """Compute the state at the given exec point by restoring the nearest
+        checkpoint and replaying the diffs from there"""
+        interval = self._checkpoint_interval
+        checkpoint = min(exec_point // interval, len(self._checkpoints) - 1)
+        checkpoint_point = checkpoint * interval
+        # only restore the checkpoint if it is closer than where we are now
+        if not checkpoint_point <= self._exec_point <= exec_point:
+            self._func_states = FunctionStates(self._checkpoints[checkpoint])
+            self._exec_point = checkpoint_point
+        while self._exec_point < exec_point:
+            self._exec_point += 1
+            self._apply(self.curr_diff)
+
+    def step_to(self, exec_point):
+        """Go to the exec point that stepping towards the given one would
+        reach, but jump there by restoring the nearest checkpoint."""
+        exec_point = max(1, min(exec_point, len(self._exec_state_diffs) - 1))
+        if exec_point > self._exec_point:
+            if self.at_end:
+                self._direction = Direction.FORWARD
+                return
+            # we can't step over exceptions
+            exec_point = min(exec_point, self.next_exception_point())
+        if not self.is_stop_point(exec_point):
+            # stepping stops at the implicit return statement instead
+            exec_point += 1
+        if exec_point > self._exec_point:
+            self._direction = Direction.FORWARD
+        elif exec_point < self._exec_point:
+            self._direction = Direction.BACKWARD
+        self.seek(exec_point)
+
+    def step_to_clock(self, clock):
+        """Go to the last exec point at or before the given logical time, or
+        to the start if there is none"""
+        self.step_to(bisect_right(self._clocks, clock) - 1)
+
+    def step_back_to(self, exec_point):
+        """Go back to the given exec point, which has to be reachable by
+        stepping backwards from the current one"""
+        self._direction = Direction.BACKWARD
+        self.seek(exec_point)
+
+    def reached_backward(self, exec_point):
+        """check whether stepping backwards from the current exec point
+        stops at the given one. Stepping backwards over an implicit return
+        skips the line before it, so in a sequence of returns only every
+        other exec point is reached."""
+        top = exec_point
+        while (
+            top < self._exec_point
+            and self._exec_state_diffs[top + 1].action == Action.RET
+        ):
+            top += 1
+        return (top - exec_point) % 2 == 0
+
+    def exec_points_at(self, file_name, lineno):
+        """ return the sorted exec points that are at the given line """
+        if self._line_index is None:
+            self._line_index = self._build_line_index()
+        return self._line_index.get((file_name, lineno), ())
+
+    def _build_line_index(self):
+        diffs = self._exec_state_diffs
+        index = {}
+        if hasattr(diffs, "file_ids"):
+            # use the columns of the trace, so we don't create the diffs
+            locations = zip(diffs.file_ids, diffs.linenos)
+        else:
+            locations = ((diff.file_name, diff.lineno) for diff in diffs)
+        for exec_point, location in enumerate(locations):
+            try:
+                index[location].append(exec_point)
+            except KeyError:
+                index[location] = array("i", (exec_point,))
+        if hasattr(diffs, "file_ids"):
+            index = {
+                (diffs.string(file_id), lineno): exec_points
+                for (file_id, lineno), exec_points in index.items()
+            }
+        return index
+
+    def exec_points_of_task(self, task):
+        """ return the sorted exec points of the given asyncio task """
+        if self._task_index is None:
+            diffs = self._exec_state_diffs
+            if hasattr(diffs, "tasks"):
+                tasks = diffs.tasks
+            else:
+                tasks = [diff.task for diff in diffs]
+            self._task_index = {}
+            for exec_point, task_ in enumerate(tasks):
+                if task_ is not None:
+                    self._task_index.setdefault(task_, array("i")).append(
+                        exec_point
+                    )
+        return self._task_index.get(task, ())
+
+    def _steps_in_task(self):
+        """Yield the exec points after the current one at which the current
+        asyncio task is in the current function or one of its callers. A
+        coroutine that awaits something is suspended, it returns to the event
+        loop and is called again when it is resumed. The steps in between
+        belong to other functions of the task, so they are skipped."""
+        task = self.curr_diff.task
+        if task is None:
+            return
+        diffs = self._exec_state_diffs
+        depth = self.curr_depth
+        frame_hash = self.curr_diff.frame.frame
+        exec_points = self.exec_points_of_task(task)
+        # steps out of the current function, that are only yielded if it
+        # returned and was not suspended
+        pending = []
+        for exec_point in exec_points[
+            bisect_right(exec_points, self._exec_point) :
+        ]:
+            diff = diffs[exec_point]
+            if diff.depth > depth:
+                continue
+            elif diff.depth < depth:
+                pending.append(exec_point)
+            elif (
+                diff.action == Action.CALL
+                and diff.frame.resumed
+                and diff.frame.frame == frame_hash
+            ):
+                # the function continues after the await
+                pending = []
+            elif pending:
+                # we returned and another function was called
+                break
+            else:
+                yield exec_point
+        yield from pending
+
+    def next_in_task(self):
+        """Return the exec point at which stepping over the current line
+        stops if only the steps of the current asyncio task count, or None
+        if we are not in a task or it makes no more steps"""
+        for exec_point in self._steps_in_task():
+            if self.is_stop_point(exec_point):
+                return exec_point
+        return None
+
+    def finish_in_task(self):
+        """Return the exec point of the last step of the current function
+        before it returns, if only the steps of the current asyncio task
+        count. None if we are not in a task or it makes no more steps."""
+        depth = self.curr_depth
+        target = None
+        for exec_point in self._steps_in_task():
+            if self._exec_state_diffs[exec_point].depth < depth:
+                break
+            if self.is_stop_point(exec_point):
+                target = exec_point
+        return target
+
+    def is_stop_point(self, exec_point):
+        """check whether stepping can stop at the given exec point, which is
+        not the case if the next diff is an implicit return"""
+        try:
+            return self._exec_state_diffs[exec_point + 1].action != Action.RET
+        except IndexError:
+            return True
+
+    @property
+    def exception_points(self):
+        """ the sorted exec points of all exceptions """
+        if self._exception_points is None:
+            diffs = self._exec_state_diffs
+            if hasattr(diffs, "actions"):
+                # use the column of the trace, so we don't create the diffs
+                exception = Action.EXCEPTION.value
+                actions = diffs.actions
+            else:
+                exception = Action.EXCEPTION
+                actions = (diff.action for diff in diffs)
+            self._exception_points = [
+                i for i, action in enumerate(actions) if action == exception
+            ]
+        return self._exception_points
+
+    def next_exception_point(self):
+        """ return the exec point of the next exception after the current one """
+        exception_points = self.exception_points
+        i = bisect_right(exception_points, self._exec_point)
+        if i < len(exception_points):
+            return exception_points[i]
+        return len(self._exec_state_diffs) - 1
+
     @property
     def at_start(self):
         return self._exec_point < 2
@@ -238,10 +455,22 @@ class StateMachine(object):
     def curr_state(self):
         return self._func_states[self.curr_diff.func_name]
 
+    @property
+    def curr_scopes(self):
+        """ copies of the scopes of all active functions, the outermost first """
+        return self._func_states.checkpoint()
+
     @property
     def curr_depth(self):
-        func_states = self.curr_diff.get_function_states()
-        return len(func_states) - 1
+        return self.curr_diff.depth
+
+    @property
+    def clock(self):
+        """the logical time of the current exec point, which is the exec point
+        itself if we don't debug threads"""
+        if self._clocks is None:
+            return self._exec_point
+        return self._clocks[self._exec_point]
 
 
 class TimeTravelDebugger(object):
@@ -251,14 +480,26 @@ class TimeTravelDebugger(object):
         source_map,
         update,
         search_engine,
+        threads=None,
     ):
         # Dictionary that contains source code objects for each frame
         self._source_map = source_map
+        # ThreadTraces of all threads if we debug a recording of threads, the
+        # first one is the one of exec_state_diffs
+        self._threads = list(threads or [])
+        self._thread_id = self._threads[0].id if self._threads else 0
+        clocks = self._threads[0].clocks if self._threads else None
+        # StateMachines of the other threads we debugged, by thread id
+        self._thread_state_machines = {}
         # The current state of variables:
-        self._state_machine = StateMachine(exec_state_diffs)
+        self._state_machine = StateMachine(exec_state_diffs, clocks=clocks)
+        # if True, next and finish skip the steps of other asyncio tasks
+        self._follow_task = False
 
         self._breakpoints = []
         self._watchpoints = []
+        # index of the active breakpoints by location
+        self._index_breakpoints()
         self._call_stack_depth = 0
         # que of lines in callstack, after moving down the callstack
         self._call_stack_return_lines = []
@@ -266,9 +507,6 @@ class TimeTravelDebugger(object):
         # search enginge
         self._search_engine = search_engine
 
-        # needed to check if we  need to reset the search engine
-        self._last_break_points = []
-
         self._update = update
 
     def trigger_update(func):
@@ -279,25 +517,20 @@ class TimeTravelDebugger(object):
         def nfunc(self, *args, **kwargs):
             ret = func(self, *args, **kwargs)
 
-            state = self.curr_state
+            # without a UI (see TraceAnalysis) there is nothing to update and
+            # the watchpoints are not evaluated either
+            if self._update is not None:
+                state = self.curr_state
 
-            for wp in self.watchpoints:
-                wp.update(state)
+                for wp in self.watchpoints:
+                    wp.update(state)
 
-            self._update(state)
+                self._update(state)
             self._call_stack_depth = self._state_machine.curr_diff.depth
             return ret
 
         return nfunc
 
-    @property
-    def _last_search_exec_point(self):
-        return self._state_machine._last_search_exec_point
-
-    @_last_search_exec_point.setter
-    def _last_search_exec_point(self, last_search_exec_point):
-        self._state_machine._last_search_exec_point = last_search_exec_point
-
     @property
     def source_map(self):
         return self._source_map
@@ -338,36 +571,137 @@ class TimeTravelDebugger(object):
     def curr_state(self):
         return self._state_machine.curr_state
 
+    @property
+    def curr_scopes(self):
+        return self._state_machine.curr_scopes
+
+    @property
+    def exec_point(self):
+        return self._state_machine._exec_point
+
+    @property
+    def exception_points(self):
+        return self._state_machine.exception_points
+
+    @property
+    def threads(self):
+        return self._threads
+
+    @property
+    def thread_id(self):
+        return self._thread_id
+
+    @trigger_update
+    def switch_thread(self, thread_id):
+        """Debug the thread with the given id, at the last step it made up to
+        the current step of the current thread. Returns False if there is no
+        such thread."""
+        threads = {thread.id: thread for thread in self._threads}
+        if thread_id not in threads:
+            return False
+        clock = self._state_machine.clock
+        self._thread_state_machines[self._thread_id] = self._state_machine
+        state_machine = self._thread_state_machines.get(thread_id)
+        if state_machine is None:
+            thread = threads[thread_id]
+            state_machine = StateMachine(thread.diffs, clocks=thread.clocks)
+        state_machine.step_to_clock(clock)
+        self._state_machine = state_machine
+        self._thread_id = thread_id
+        self._call_stack_return_lines = []
+        return True
+
+    @property
+    def task(self):
+        """ name of the asyncio task of the current step, or None """
+        return self._state_machine.curr_diff.task
+
+    @property
+    def follow_task(self):
+        return self._follow_task
+
+    @follow_task.setter
+    def follow_task(self, follow):
+        self._follow_task = follow
+
+    @property
+    def state_is_approximate(self):
+        """True if the variables of the current line were not sampled, so the
+        current state is the one of the last sampled line of the function"""
+        return self._state_machine.curr_diff.action == Action.LINE
+
+    def _index_breakpoints(self):
+        """(Re)build the index of the active breakpoints, which maps
+        (abs_filename, lineno) to the breakpoints at that location. Function
+        breakpoints are indexed by their start line (hit going forward) and
+        their end line (hit going backward)."""
+        self._line_breakpoints = {}
+        self._func_start_breakpoints = {}
+        self._func_end_breakpoints = {}
+        for bp in self._breakpoints:
+            self._index_breakpoint(bp)
+
+    def _breakpoint_index_entries(self, bp):
+        if bp.breakpoint_type == BPType.FUNC:
+            return (
+                (self._func_start_breakpoints, bp.startline),
+                (self._func_end_breakpoints, bp.endline),
+            )
+        return ((self._line_breakpoints, bp.lineno),)
+
+    def _index_breakpoint(self, bp):
+        if not bp.active:
+            return
+        for index, lineno in self._breakpoint_index_entries(bp):
+            index.setdefault((bp.abs_filename, lineno), []).append(bp)
+
+    def _unindex_breakpoint(self, bp):
+        for index, lineno in self._breakpoint_index_entries(bp):
+            key = (bp.abs_filename, lineno)
+            bps = index.get(key, [])
+            if bp in bps:
+                # compare by identity, since breakpoints compare by id and
+                # state
+                index[key] = [b for b in bps if b is not bp]
+                if not index[key]:
+                    del index[key]
+
+    def has_active_breakpoints(self):
+        return bool(self._line_breakpoints or self._func_start_breakpoints)
+
+    def get_current_breaks(self):
+        """ return the active breakpoints that are hit at the current line """
+        diff = self.curr_diff
+        key = (diff.file_name, diff.lineno)
+        res = []
+        for bp in self._line_breakpoints.get(key, ()):
+            if bp.eval_condition(self.curr_state):
+                res.append(bp)
+        if self._state_machine.direction == Direction.FORWARD:
+            res.extend(self._func_start_breakpoints.get(key, ()))
+        else:
+            res.extend(self._func_end_breakpoints.get(key, ()))
+        return sorted(res, key=lambda bp: bp.id)
+
     def break_at_current(self):
-        for bp in self.breakpoints:
-            if self.is_at_breakpoint(bp) and bp.active:
+        diff = self.curr_diff
+        key = (diff.file_name, diff.lineno)
+        if self._state_machine.direction == Direction.FORWARD:
+            if key in self._func_start_breakpoints:
+                return True
+        elif key in self._func_end_breakpoints:
+            return True
+        for bp in self._line_breakpoints.get(key, ()):
+            if bp.eval_condition(self.curr_state):
                 return True
         return False
 
     def get_ids_of_current_breaks(self):
-        res = []
-        for bp in self.breakpoints:
-            if self.is_at_breakpoint(bp) and bp.active:
-                res.append(str(bp.id))
-        return res
+        return [str(bp.id) for bp in self.get_current_breaks()]
 
     def is_line_breakpoint(self, line, filename=None):
         filename = filename or self.curr_diff.file_name
-        source = self.find_source_for_location(filename, line)
-
-        if source is None:
-            return False
-
-        file = source["filename"]
-        for bp in self.breakpoints:
-            if bp.abs_filename != file:
-                continue
-            if bp.breakpoint_type == BPType.FUNC:
-                continue
-            else:
-                if bp.lineno == line and bp.active:
-                    return True
-        return False
+        return (filename, line) in self._line_breakpoints
 
     def is_at_line(self, line):
         return self.curr_line == line
@@ -394,7 +728,8 @@ class TimeTravelDebugger(object):
         # since we start at exec_point we have to step once to start at the
         # correct point and update the UI
         self._state_machine.forward()
-        self._update(self._state_machine.curr_state)
+        if self._update is not None:
+            self._update(self._state_machine.curr_state)
 
     @trigger_update
     def step_forward(self):
@@ -406,27 +741,45 @@ class TimeTravelDebugger(object):
         """ Step backward one step at a time """
         self._state_machine.backward()
 
+    @trigger_update
+    def goto(self, exec_point):
+        """Go to the given exec point directly, unlike step_to_index also
+        past exceptions"""
+        last = len(self._state_machine._exec_state_diffs) - 1
+        self._state_machine.seek(max(1, min(exec_point, last)))
+
     @trigger_update
     def step_to_index(self, index, ignore_breakpoints=False):
         def break_():
             return self.break_at_current() and not ignore_breakpoints
 
-        while index < self._state_machine._exec_point and not break_():
-            self._state_machine.backward()
+        if ignore_breakpoints or not self.has_active_breakpoints():
+            # no breakpoint can stop us on the way, so jump there directly
+            self._state_machine.step_to(index)
+            return self.break_at_current()
 
-        while index > self._state_machine._exec_point and not break_():
-            self._state_machine.forward()
+        self._run_backward(index)
+        self._run_forward(index)
 
         return self.break_at_current()
 
     def next(self):
-        self.until()
+        target = self._state_machine.next_in_task() if self._follow_task else None
+        if target is not None:
+            self.step_to_index(target)
+        else:
+            self.until()
 
     def previous(self):
         self.until(direction=Direction.BACKWARD)
 
     @trigger_update
     def finish(self):
+        if self._follow_task:
+            target = self._state_machine.finish_in_task()
+            if target is not None:
+                self._run_forward(target)
+                return
         curr_depth = self._state_machine.curr_depth
         # only take in account return actions that happened in the same
         # function scope (in the same depth)
@@ -461,30 +814,113 @@ class TimeTravelDebugger(object):
     @trigger_update
     def continue_(self):
         self._state_machine.forward()
-        while not (self.break_at_current() or self._state_machine.at_end):
-            self._state_machine.forward()
+        self._run_forward(len(self._state_machine._exec_state_diffs) - 1)
 
     @trigger_update
     def reverse(self):
         self._state_machine.backward()
-        while not (self.break_at_current() or self._state_machine.at_start):
-            self._state_machine.backward()
+        self._run_backward(0)
+
+    def _break_locations(self, direction):
+        """ return the locations at which a breakpoint could be hit """
+        if direction == Direction.FORWARD:
+            func_breakpoints = self._func_start_breakpoints
+        else:
+            func_breakpoints = self._func_end_breakpoints
+        return list(self._line_breakpoints) + list(func_breakpoints)
+
+    def _next_break_candidate(self):
+        """return the next exec point after the current one at which a
+        breakpoint could be hit going forward, or None"""
+        exec_point = self._state_machine._exec_point
+        candidate = None
+        for file_name, lineno in self._break_locations(Direction.FORWARD):
+            exec_points = self._state_machine.exec_points_at(file_name, lineno)
+            i = bisect_right(exec_points, exec_point)
+            if i < len(exec_points) and (
+                candidate is None or exec_points[i] < candidate
+            ):
+                candidate = exec_points[i]
+        return candidate
+
+    def _prev_break_candidate(self, limit):
+        """return the last exec point before the current one and not before
+        limit at which a breakpoint could be hit going backward, or None"""
+        exec_point = self._state_machine._exec_point
+        locations = self._break_locations(Direction.BACKWARD)
+        while True:
+            candidate = None
+            for file_name, lineno in locations:
+                exec_points = self._state_machine.exec_points_at(
+                    file_name, lineno
+                )
+                i = bisect_left(exec_points, exec_point) - 1
+                if i >= 0 and (candidate is None or exec_points[i] > candidate):
+                    candidate = exec_points[i]
+            if candidate is None or candidate < limit:
+                return None
+            if self._state_machine.reached_backward(candidate):
+                return candidate
+            # we would step over this one, so look further back
+            exec_point = candidate
+
+    def _run_forward(self, limit):
+        """Step forward until a breakpoint is hit, or the end or the given exec
+        point is reached. Instead of checking every step, jump from one
+        possible breakpoint hit to the next."""
+        state_machine = self._state_machine
+        while state_machine._exec_point < limit and not (
+            self.break_at_current() or state_machine.at_end
+        ):
+            target = self._next_break_candidate()
+            if target is None or target > limit:
+                target = limit
+            state_machine.step_to(target)
+
+    def _run_backward(self, limit):
+        """Step backward until a breakpoint is hit, or the start or the given
+        exec point is reached, like _run_forward"""
+        state_machine = self._state_machine
+        # exec point at which stepping backward reaches the start
+        start = 1 if state_machine.reached_backward(1) else 0
+        while state_machine._exec_point > limit and not (
+            self.break_at_current() or state_machine.at_start
+        ):
+            target = self._prev_break_candidate(limit)
+            if target is None:
+                if state_machine.reached_backward(limit):
+                    target = limit
+                else:
+                    target = limit - 1
+            state_machine.step_back_to(max(target, start))
+
+    def _init_search_engine(self):
+        # the search engine only records what changed since the last search
+        self._search_engine.init(
+            self._state_machine._exec_state_diffs,
+            self._breakpoints,
+            self._watchpoints,
+        )
 
     def search(self, event_type, query):
         event_type = EventType(event_type)
-        if (
-            self._last_search_exec_point != self._state_machine._exec_point
-            or self._last_break_points != self._breakpoints
-        ):
-            self._last_search_exec_point = self._state_machine._exec_point
-            self._last_break_points = deepcopy(self._breakpoints)
-            self._search_engine.init(
-                self._state_machine._exec_state_diffs,
-                self._breakpoints,
-                self._watchpoints,
-            )
+        self._init_search_engine()
         return self._search_engine.search_events(event_type, query)
 
+    def first_change_to(self, var_name, value):
+        """return the event of the change at which the variable first took
+        the given value, or None"""
+        self._init_search_engine()
+        return self._search_engine.first_change_to(var_name, value)
+
+    def last_change(self, var_name):
+        """return the event of the last change of the variable before the
+        current exec point, or None"""
+        self._init_search_engine()
+        return self._search_engine.last_change_before(
+            var_name, self._state_machine._exec_point
+        )
+
     @trigger_update
     def until(
         self, line_no=0, file_name="", func=False, direction=Direction.FORWARD
@@ -628,6 +1064,7 @@ class TimeTravelDebugger(object):
             breakpoint = Breakpoint(id, lineno, filename, cond)
 
         self.breakpoints.append(breakpoint)
+        self._index_breakpoint(breakpoint)
         return breakpoint
 
     def get_source_for_func(self, funcname=None):
@@ -735,12 +1172,14 @@ class TimeTravelDebugger(object):
         b = self.get_breakpoint(id)
         if b is not None:
             self.breakpoints.remove(b)
+            self._unindex_breakpoint(b)
             return True
         return False
 
     def disable_breakpoint(self, id):
         breakpoint = self.get_breakpoint(id)
         if breakpoint is not None:
+            self._unindex_breakpoint(breakpoint)
             breakpoint.disable()
             return True
         return False
@@ -748,14 +1187,18 @@ class TimeTravelDebugger(object):
     def enable_breakpoint(self, id):
         breakpoint = self.get_breakpoint(id)
         if breakpoint is not None:
+            self._unindex_breakpoint(breakpoint)
             breakpoint.enable()
+            self._index_breakpoint(breakpoint)
             return True
         return False
 
     def toggle_breakpoint(self, id):
         breakpoint = self.get_breakpoint(id)
         if breakpoint is not None:
+            self._unindex_breakpoint(breakpoint)
             breakpoint.toggle()
+            self._index_breakpoint(breakpoint)
             return True
         return False
 
@@ -783,3 +1226,80 @@ class TimeTravelDebugger(object):
             self.watchpoints.remove(b)
             return True
         return False
+
+    def compute_timeline(self, id):
+        """Evaluate the watchpoint once at every step and store the exec
+        points at which its value changes in its timeline, so until_change
+        only has to look them up. Like stepping, this stops at the first
+        exception. Returns the watchpoint, or None if there is no such
+        watchpoint."""
+        wp = self.get_watchpoint(id)
+        if wp is None:
+            return None
+        diffs = self._state_machine._exec_state_diffs
+        # replay the trace with an own state machine, so we stay where we are
+        state_machine = StateMachine(diffs)
+        state_machine.forward()
+        value = wp.evaluate(state_machine.curr_state)
+        timeline = array("l")
+        while not state_machine.at_end:
+            exec_point = state_machine._exec_point
+            state_machine.forward()
+            # the value can only change if a step in between changed the
+            # variables or the function we are in
+            steps = range(exec_point + 1, state_machine._exec_point + 1)
+            if not any(
+                diffs[i].action in (Action.CALL, Action.RET)
+                or diffs[i].added
+                or diffs[i].updated
+                for i in steps
+            ):
+                continue
+            new_value = wp.evaluate(state_machine.curr_state)
+            if values_differ(new_value, value):
+                timeline.append(state_machine._exec_point)
+                value = new_value
+        wp.timeline = timeline
+        return wp
+
+    @trigger_update
+    def until_change(self, id, direction=Direction.FORWARD):
+        """Run until the value of the watchpoint changes. Uses the timeline of
+        the watchpoint if it was computed, otherwise the watchpoint is
+        evaluated at every step. Returns False if there is no such
+        watchpoint."""
+        wp = self.get_watchpoint(id)
+        if wp is None:
+            return False
+        state_machine = self._state_machine
+        exec_point = state_machine._exec_point
+        if wp.timeline is not None:
+            timeline = wp.timeline
+            if direction == Direction.FORWARD:
+                i = bisect_right(timeline, exec_point)
+                if i < len(timeline):
+                    state_machine.step_to(timeline[i])
+                else:
+                    state_machine.step_to(len(state_machine._exec_state_diffs))
+            else:
+                # the value changes again before the change that led to the
+                # current value
+                i = bisect_right(timeline, exec_point) - 1
+                if i >= 0:
+                    state_machine.step_back_to(timeline[i])
+                    state_machine.backward()
+                else:
+                    state_machine.step_to(1)
+            return True
+        if direction == Direction.FORWARD:
+            move = state_machine.forward
+            at_limit = lambda: state_machine.at_end
+        else:
+            move = state_machine.backward
+            at_limit = lambda: state_machine.at_start
+        value = wp.evaluate(state_machine.curr_state)
+        while not at_limit():
+            move()
+            if values_differ(wp.evaluate(state_machine.curr_state), value):
+                break
+        return True
@@ -0,0 +1,345 @@
+import ast
+import builtins
+import re
+import sys
+from bisect import bisect_left, bisect_right
+
+
+# value predicates reach from "-if" to the next option or the end of the query
+PREDICATE = re.compile(
+    r"-\s*if\b(.*?)(?=-\s*(?:line|func|depth|step|if)\b|$)", re.DOTALL
+)
+OPTION = re.compile(r"(line|func|depth|step)(?![A-Za-z_])\s*(.*)", re.DOTALL)
+
+
+def parse_range(text):
+    """parse a range like '12', '10:20', '10:' or ':20' into an inclusive
+    (low, high) tuple"""
+    low, sep, high = text.partition(":")
+    try:
+        low = int(low) if low.strip() else -sys.maxsize
+        high = int(high) if high.strip() else sys.maxsize
+    except ValueError:
+        raise ValueError(f"Invalid range: '{text}'")
+    if not sep:
+        if low == -sys.maxsize:
+            raise ValueError("Missing range")
+        high = low
+    return low, high
+
+
+def in_ranges(value, ranges):
+    return any(low <= value <= high for low, high in ranges)
+
+
+def free_names(expression):
+    """return the variables an expression looks up, except builtins and the
+    names it binds itself, e.g. in a comprehension. Attributes like the x
+    of p.x are no variables."""
+    loaded = set()
+    bound = set()
+    for node in ast.walk(ast.parse(expression, mode="eval")):
+        if isinstance(node, ast.Name):
+            if isinstance(node.ctx, ast.Load):
+                loaded.add(node.id)
+            else:
+                bound.add(node.id)
+        elif isinstance(node, ast.arg):
+            bound.add(node.arg)
+    return loaded - bound - set(dir(builtins))
+
+
+class KeyClause(object):
+    """ matches events whose attribute is one of the given keys """
+
+    def __init__(self, attr, keys):
+        self.attr = attr
+        self.keys = set(keys)
+
+    def _keys(self, events):
+        return self.keys
+
+    def estimate(self, events):
+        postings = events.postings(self.attr)
+        return sum(len(postings.get(key, ())) for key in self._keys(events))
+
+    def positions(self, events):
+        postings = events.postings(self.attr)
+        res = set()
+        for key in self._keys(events):
+            res.update(postings.get(key, ()))
+        return res
+
+    def matches(self, event, context):
+        return getattr(event, self.attr) in self.keys
+
+
+class RangeClause(KeyClause):
+    """ matches events whose integer attribute lies in one of the ranges """
+
+    def __init__(self, attr, ranges):
+        self.attr = attr
+        self.ranges = ranges
+
+    def _keys(self, events):
+        return [
+            key
+            for key in events.postings(self.attr)
+            if in_ranges(key, self.ranges)
+        ]
+
+    def matches(self, event, context):
+        return in_ranges(int(getattr(event, self.attr)), self.ranges)
+
+
+class StepClause(object):
+    """matches events in one of the given exec point windows. Events are
+    ordered by exec point, so the windows are found by binary search."""
+
+    def __init__(self, ranges):
+        self.ranges = ranges
+
+    def _slices(self, events):
+        exec_points = events.exec_points
+        for low, high in self.ranges:
+            yield (
+                bisect_left(exec_points, low),
+                bisect_right(exec_points, high),
+            )
+
+    def estimate(self, events):
+        return sum(stop - start for start, stop in self._slices(events))
+
+    def positions(self, events):
+        res = set()
+        for start, stop in self._slices(events):
+            res.update(range(start, stop))
+        return res
+
+    def matches(self, event, context):
+        return in_ranges(event.exec_point, self.ranges)
+
+
+class PredicateClause(object):
+    """matches events for which a python expression is true. It can't be
+    answered from the indexes, so it is always checked last."""
+
+    def __init__(self, expression):
+        self.expression = expression
+        # raises a SyntaxError if the expression is invalid
+        self.code = compile(expression, "<query>", "eval")
+        self.names = free_names(expression)
+
+    def estimate(self, events):
+        return float("inf")
+
+    def matches(self, event, context):
+        # context returns a new dict of the values the expression can see
+        try:
+            return bool(eval(self.code, context(event)))
+        except Exception:
+            return False
+
+
+class Query(object):
+    """A search query compiled into clauses that all have to match.
+
+    Besides the ids to search for the query can contain the options
+        -func name      events in the function
+        -line 12        events at a line, or in a range of lines like 10:20
+        -depth 1        events at a call depth, or a range like 1:3
+        -step 100:500   events in a window of exec points
+        -if x > 100     events for which the python expression is true
+    Repeated options match any of their values, except -if which all have
+    to be true. Ids are separated by '-' as well."""
+
+    def __init__(
+        self,
+        ids=(),
+        func_names=(),
+        lines=(),
+        depths=(),
+        steps=(),
+        predicates=(),
+    ):
+        self.ids = list(ids)
+        self.func_names = list(func_names)
+        self.lines = list(lines)
+        self.depths = list(depths)
+        self.steps = list(steps)
+        self.predicates = [PredicateClause(p) for p in predicates]
+
+    @classmethod
+    def parse(cls, query):
+        """ parses the search criteria of a query """
+        predicates = [m.group(1).strip() for m in PREDICATE.finditer(query)]
+        query = PREDICATE.sub(" ", query)
+
+        ids = []
+        func_names = []
+        lines = []
+        depths = []
+        steps = []
+
+        # remove any string delimiters
+        query = query.replace('"','')
+        query = query.replace("'",'')
+
+        for number, phrase in enumerate(query.split('-')):
+            phrase = phrase.strip()
+            # options follow a "-", the phrase before the first one is an id
+            match = OPTION.match(phrase) if number else None
+            option, value = match.groups() if match else (None, phrase)
+            value = value.strip()
+            if option == "line":
+                lines.append(parse_range(value))
+            elif option == "func":
+                func_names.append(value)
+            elif option == "depth":
+                depths.append(parse_range(value))
+            elif option == "step":
+                steps.append(parse_range(value))
+            elif phrase:
+                ids.append(phrase)
+
+        return cls(ids, func_names, lines, depths, steps, predicates)
+
+    def plan(self, named_values):
+        """return the clauses of the query. If named_values is set, values
+        are bound to the name of the event id, so a predicate can only match
+        the events of the variables it names."""
+        clauses = []
+        ids = set(self.ids) if self.ids else None
+        if named_values:
+            for predicate in self.predicates:
+                if predicate.names and ids is None:
+                    ids = set(predicate.names)
+                elif predicate.names:
+                    ids &= predicate.names
+        if ids is not None:
+            clauses.append(KeyClause("id", ids))
+        if self.func_names:
+            clauses.append(KeyClause("func", self.func_names))
+        if self.lines:
+            clauses.append(RangeClause("line", self.lines))
+        if self.depths:
+            clauses.append(RangeClause("depth", self.depths))
+        if self.steps:
+            clauses.append(StepClause(self.steps))
+        return clauses + self.predicates
+
+    def run(self, events, context, named_values=False):
+        """Return the matching events as lazy SearchResults. The most
+        selective clause selects the candidates from the indexes, the others
+        are checked per candidate from the most to the least selective
+        one."""
+        clauses = sorted(
+            self.plan(named_values), key=lambda clause: clause.estimate(events)
+        )
+        if clauses and not isinstance(clauses[0], PredicateClause):
+            candidates = sorted(clauses.pop(0).positions(events))
+        else:
+            candidates = range(len(events))
+        return SearchResults(events, candidates, clauses, context)
+
+
+class SearchResults(object):
+    """Lazy results of a query. Candidates are only checked when results are
+    requested and the matches found so far are remembered, so the results
+    can be read page by page."""
+
+    # number of results read at once while iterating
+    PAGE_SIZE = 100
+
+    def __init__(self, events, candidates, clauses, context):
+        self._events = events
+        # sorted positions of the events that may match
+        self._candidates = candidates
+        # clauses the candidates still have to match
+        self._clauses = clauses
+        self._context = context
+        # positions of the matches found so far
+        self._matches = []
+        # number of candidates we checked
+        self._checked = 0
+
+    def _find(self, count):
+        """ check candidates until we found count matches or none are left """
+        candidates = self._candidates
+        while len(self._matches) < count and self._checked < len(candidates):
+            position = candidates[self._checked]
+            self._checked += 1
+            event = self._events[position]
+            for clause in self._clauses:
+                if not clause.matches(event, self._context):
+                    break
+            else:
+                self._matches.append(position)
+
+    def page(self, offset, limit):
+        """ return at most limit matching events, starting at offset """
+        if self._clauses:
+            self._find(offset + limit)
+            positions = self._matches[offset : offset + limit]
+        else:
+            # every candidate matches
+            positions = self._candidates[offset : offset + limit]
+        return [self._events[position] for position in positions]
+
+    @property
+    def complete(self):
+        """ whether all results are known, so len is cheap """
+        return not self._clauses or self._checked == len(self._candidates)
+
+    @property
+    def found(self):
+        """the number of results found so far, without checking any more
+        candidates. It is the total number once the results are complete."""
+        if self._clauses:
+            return len(self._matches)
+        return len(self._candidates)
+
+    def __len__(self):
+        """the total number of results, which checks all candidates that are
+        left. Use found and complete while reading pages."""
+        if self._clauses:
+            self._find(len(self._candidates))
+        return self.found
+
+    def __bool__(self):
+        return bool(self.page(0, 1))
+
+    def __iter__(self):
+        offset = 0
+        while True:
+            events = self.page(offset, self.PAGE_SIZE)
+            if not events:
+                return
+            yield from events
+            offset += len(events)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start = index.start or 0
+            step = index.step or 1
+            stop = index.stop
+            if step > 0 and start >= 0 and stop is not None and stop >= 0:
+                return self.page(start, max(stop - start, 0))[::step]
+            # positions counted from the end need all results
+            positions = range(*index.indices(len(self)))
+            if not positions:
+                return []
+            first = min(positions[0], positions[-1])
+            events = self.page(first, abs(positions[-1] - positions[0]) + 1)
+            return [events[position - first] for position in positions]
+        # a negative index needs all results
+        if index < 0:
+            index += len(self)
+        events = self.page(index, 1) if index >= 0 else []
+        if not events:
+            raise IndexError("search result index out of range")
+        return events[0]
+
+    def __repr__(self):
+        more = "" if self.complete else "+"
+        return f"<SearchResults: {self.found}{more} events>"
@@ -0,0 +1,105 @@
+import functools
+import sys
+import threading
+import warnings
+
+from ..model.recording import Recording
+from .tracer import TimeTravelTracer
+
+# a recording is only active in the thread that started it
+_local = threading.local()
+
+
+class Recorder(object):
+    """Records code without a user interface, the options are the ones of
+    TimeTravelTracer. Either call start and stop, which returns the
+    Recording, or use it as context manager, then the Recording is in
+    recording afterwards:
+
+        with Recorder(sample_every=10) as recorder:
+            run()
+        TimeTravelCLI().debug(*recorder.recording)
+
+    A trace function that is set already, e.g. the one of coverage.py or of
+    a debugger, is suspended while recording with settrace and set again
+    afterwards.
+    """
+
+    def __init__(self, **tracer_options):
+        self._tracer_options = tracer_options
+        self._tracer = None
+        self._recording = None
+        self._previous_trace = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        """ Record everything that is called from now on until stop """
+        if self._tracer is not None:
+            raise RuntimeError("The recorder is already recording")
+        self._previous_trace = sys.gettrace()
+        self._tracer = TimeTravelTracer(**self._tracer_options)
+        self._tracer.set_trace()
+        _local.active = True
+        if self._previous_trace not in (None, sys.gettrace()):
+            warnings.warn(
+                f"The trace function {self._previous_trace!r} is suspended "
+                f"while recording",
+                RuntimeWarning,
+                stacklevel=2,
+            )
+
+    def stop(self):
+        """ Stop recording and return the Recording """
+        if self._tracer is None:
+            raise RuntimeError("The recorder is not recording")
+        tracer, self._tracer = self._tracer, None
+        diffs, source_map = tracer.get_trace()
+        _local.active = False
+        if self._previous_trace is not None and sys.gettrace() is None:
+            sys.settrace(self._previous_trace)
+        self._previous_trace = None
+        self._recording = Recording(diffs, source_map, tracer.threads)
+        return self._recording
+
+    @property
+    def recording(self):
+        """ The Recording of the last start and stop """
+        return self._recording
+
+
+def record(func=None, *, callback=None, **tracer_options):
+    """Decorator that records every call of the function, with the given
+    options of TimeTravelTracer. The Recording of each call is passed to
+    callback, or appended to the recordings list of the decorated function
+    if there is none. The program runs without tracing outside of the calls.
+
+    Calls made while a Recorder records already in the same thread, e.g.
+    recursive calls, are part of that recording and not recorded on their
+    own.
+    """
+    if func is None:
+        return functools.partial(record, callback=callback, **tracer_options)
+
+    @functools.wraps(func)
+    def recorded(*args, **kwargs):
+        if getattr(_local, "active", False):
+            return func(*args, **kwargs)
+        recorder = Recorder(**tracer_options)
+        recorder.start()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            recording = recorder.stop()
+            if callback is not None:
+                callback(recording)
+            else:
+                recorded.recordings.append(recording)
+
+    recorded.recordings = []
+    return recorded
@@ -1,19 +1,136 @@
 from ..model.exec_state_diff import Action
 from ..model.event import EventType, Event
+from ..model.breakpoint import BPType
 from ..domain.debugger import TimeTravelDebugger, StateMachine
-from copy import deepcopy
+from ..domain.query import Query
+from array import array
+from bisect import bisect_left
 from enum import Enum
 
 
+def value_hash(value):
+    """Compact fingerprint of a value, equal values have equal fingerprints.
+    Long strings and sequences are only fingerprinted by their length and
+    ends, so growing values don't take quadratic time. Unhashable values are
+    fingerprinted by their items, or by their type if they have none, values
+    with equal fingerprints are told apart by comparing them."""
+    fingerprint = _fingerprint(value, 0)
+    if fingerprint is None:
+        return hash(type(value))
+    return fingerprint
+
+
+def _fingerprint(value, depth):
+    """ hash of the value or else of its items, None if it has neither """
+    if isinstance(value, (str, bytes, list, tuple)) and len(value) > 256:
+        value = (len(value), value[:128], value[-128:])
+    try:
+        return hash(value)
+    except Exception:
+        pass
+    # values of different types can be equal, like a set and a frozenset or
+    # a dict and an OrderedDict, so the items decide
+    if isinstance(value, bytearray):
+        return _fingerprint(bytes(value), depth)
+    if isinstance(value, (set, dict)) and len(value) > 256:
+        return hash(len(value))
+    if isinstance(value, set):
+        return hash(frozenset(value))
+    if depth >= 4:
+        return None
+    if isinstance(value, (list, tuple)):
+        return hash(tuple(_fingerprint(item, depth + 1) for item in value))
+    if isinstance(value, dict):
+        return hash(
+            frozenset(
+                (key, _fingerprint(item, depth + 1))
+                for key, item in value.items()
+            )
+        )
+    return None
+
+
+def same_value(a, b):
+    try:
+        return type(a) is type(b) and bool(a == b)
+    except Exception:
+        return False
+
+
+class EventIndex(object):
+    """Helper class that holds the events of one type, ordered by exec point,
+    and indexes them by id, line, function name and depth"""
+
+    def __init__(self):
+        self._events = []
+        # exec point of each event, for binary search
+        self.exec_points = array("l")
+        # map ids, lines, function names and depths to the positions of
+        # their events
+        self._postings = {"id": {}, "line": {}, "func": {}, "depth": {}}
+
+    def __len__(self):
+        return len(self._events)
+
+    def __getitem__(self, position):
+        return self._events[position]
+
+    def append(self, event):
+        position = len(self._events)
+        self._events.append(event)
+        self.exec_points.append(event.exec_point)
+        postings = self._postings
+        postings["id"].setdefault(event.id, []).append(position)
+        postings["line"].setdefault(int(event.line), []).append(position)
+        postings["func"].setdefault(event.func, []).append(position)
+        postings["depth"].setdefault(event.depth, []).append(position)
+
+    def postings(self, attr):
+        """ return the positions of the events for each value of attr """
+        return self._postings[attr]
+
+
+class ValueTimeline(object):
+    """Helper class that holds the changes of one variable as positions of
+    their events, and indexes them by the fingerprint of the new value"""
+
+    def __init__(self):
+        self.positions = array("l")
+        self._by_value = {}
+
+    def append(self, position, value):
+        self.positions.append(position)
+        self._by_value.setdefault(value_hash(value), array("l")).append(
+            position
+        )
+
+    def positions_of(self, value):
+        """ return the positions of the changes that may have set the value """
+        return self._by_value.get(value_hash(value), ())
+
+
 class SearchEngine(TimeTravelDebugger):
     """ Search Enginge for events happening during debugging """
 
     def __init__(self):
 
-        # lists of events
-        self._var_change_events: List[Event]= []
-        self._func_call_events:  List[Event]= []
-        self._break_hit_events:  List[Event]= []
+        # the trace we recorded the events of
+        self._diffs = None
+        # indexed events
+        self._var_change_events = EventIndex()
+        self._func_call_events = EventIndex()
+        self._break_hit_events = EventIndex()
+        # ValueTimeline of each variable
+        self._value_timelines = {}
+        # flags for the exec points stepping forward stops at, events are
+        # only recorded there
+        self._stop_points = bytearray()
+        # exec points at which a breakpoint is hit, keyed by everything that
+        # decides where the breakpoint is hit. Breakpoints that did not
+        # change since the last search don't have to be evaluated again.
+        self._break_hits = {}
+        # keys of the breakpoints the break hit events were recorded for
+        self._break_keys = []
 
         # Dictionary that contains source code objects for each frame
         self._call_stack_depth = 0
@@ -24,105 +141,168 @@ class SearchEngine(TimeTravelDebugger):
         self._update = lambda : None
 
 
-    def _parse_search_query(self, query):
-        """ parses the search criteria for a query """
-        ids = []
-        func_names = []
-        line_nums = []
-        
-        # remove any string delimiters
-        query = query.replace('"','')
-        query = query.replace("'",'')
-
-        phrases = query.split('-')
-        for phrase in phrases:
-            phrase = phrase.strip()
-            if phrase.startswith("line"):
-                line_no = phrase.split("line")[-1]
-                line_nums.append(line_no.strip())
-            elif phrase.startswith("func"):
-                func_name = phrase.split("func")[-1]
-                func_names.append(func_name.strip())
-            elif phrase:
-                id = phrase
-                ids.append(id)
-
-        #  print ( ids, func_names, line_nums )
-        return ids, func_names, line_nums
-
     def search_events(self, event_type:EventType, query):
         """ search for events of a specific type in the programm execution """
-        ids, func_names, line_nums = self._parse_search_query(query)
-        #  print(ids, func_names, line_nums)
-        results = []
-        search_list = []
+        query = Query.parse(query)
         if event_type == EventType.VAR_CHANGE:
-            search_list = self._var_change_events
+            # value predicates see the new value of the variable
+            return query.run(
+                self._var_change_events, self._new_value, named_values=True
+            )
         elif event_type == EventType.BREAK_HIT:
-            search_list = self._break_hit_events
+            # value predicates see the state at the breakpoint
+            return query.run(self._break_hit_events, self._state_at)
         elif event_type == EventType.FUNC_CALL:
-            search_list = self._func_call_events
-        for event in search_list:
-            id_crit = event.id in ids if ids else True
-            line_crit = event.line in line_nums if line_nums else True
-            func_crit = event.func in func_names if func_names else True
-            if id_crit and line_crit and func_crit:
-                results.append(event)
-            #  not supported yet
-            #  if event.file in ids:
-                #  results.append(event)
-        #  print(f"results:{results}")
-        return results
+            # value predicates see the arguments of the call
+            return query.run(self._func_call_events, self._call_arguments)
+        #  not supported yet: search by file
+        return []
+
+    def first_change_to(self, var_name, value):
+        """return the variable change event at which the variable first took
+        the given value, or None"""
+        timeline = self._value_timelines.get(var_name)
+        if timeline is None:
+            return None
+        for position in timeline.positions_of(value):
+            event = self._var_change_events[position]
+            # fingerprints of different values can be equal
+            if same_value(self._new_value(event)[var_name], value):
+                return event
+        return None
+
+    def last_change_before(self, var_name, exec_point):
+        """return the last variable change event of the variable before the
+        given exec point, or None"""
+        timeline = self._value_timelines.get(var_name)
+        if timeline is None:
+            return None
+        events = self._var_change_events
+        end = bisect_left(events.exec_points, exec_point)
+        i = bisect_left(timeline.positions, end) - 1
+        if i < 0:
+            return None
+        return events[timeline.positions[i]]
+
+    def _new_value(self, event):
+        """ return the value the variable of the event changed to """
+        diff = self._diffs[event.exec_point + 1]
+        try:
+            return {event.id: diff.added[event.id]}
+        except KeyError:
+            return {event.id: diff.updated[event.id].after}
+
+    def _call_arguments(self, event):
+        """return the arguments of the called function, which is either the
+        one of the event or the one called right at its start"""
+        next_diff = self._diffs[event.exec_point + 1]
+        if next_diff.action == Action.CALL:
+            return next_diff.changed
+        return self._diffs[event.exec_point].changed
+
+    def _state_at(self, event):
+        self._state_machine.seek(event.exec_point)
+        return dict(self._state_machine.curr_state)
 
 
     def init(self, diffs, breakpoints, watchpoints):
-        """ reset the state of the program, run it once and record all events """
-        # initialize an own state machine
-        self._state_machine = StateMachine(diffs)
-        self._breakpoints = deepcopy(breakpoints)
-        self._watchpoints = deepcopy(watchpoints)
-
-        while not self.at_end:
-            line = self.curr_line
-            file = self.curr_diff.file_name
-            func = self.curr_diff.func_name
-            ids = self._check_breakpoint_hit()
-            if ids:
-                for id in ids:
-                    event = Event(EventType.BREAK_HIT\
-                            ,id,str(line),func,file,self._state_machine._exec_point)
-                    self._break_hit_events.append(event)
-            var_names = self._check_var_changes()
-            if var_names :
-                for var_name in var_names:
-                    event = Event(EventType.VAR_CHANGE\
-                            ,var_name,str(line),func,file,self._state_machine._exec_point)
-                    self._var_change_events.append(event)
-            func_name = self._check_func_call()
-            if func_name:
+        """Record all events of the program run once per trace. Afterwards
+        only the hits of breakpoints that changed since the last call are
+        computed."""
+        if diffs is not self._diffs:
+            self._diffs = diffs
+            # initialize an own state machine
+            self._state_machine = StateMachine(diffs)
+            self._break_hits = {}
+            self._break_keys = []
+            self._break_hit_events = EventIndex()
+            self._record_trace_events()
+        self._record_break_hits(breakpoints)
+
+    def _record_trace_events(self):
+        """record the variable changes and function calls of the whole trace,
+        at the exec points stepping forward stops at"""
+        diffs = self._diffs
+        last = len(diffs) - 1
+        self._var_change_events = EventIndex()
+        self._func_call_events = EventIndex()
+        self._value_timelines = {}
+        self._stop_points = bytearray(len(diffs))
+
+        exec_point = 0
+        diff = diffs[0]
+        while exec_point < last and diff.action != Action.EXCEPTION:
+            self._stop_points[exec_point] = True
+            line = str(diff.lineno)
+            file = diff.file_name
+            func = diff.func_name
+            next_diff = diffs[exec_point + 1]
+            for var_name, value in next_diff.changed.items():
+                var_name = str(var_name)
+                event = Event(EventType.VAR_CHANGE\
+                        ,var_name,line,func,file,exec_point,diff.depth)
+                try:
+                    timeline = self._value_timelines[var_name]
+                except KeyError:
+                    timeline = self._value_timelines[var_name] = ValueTimeline()
+                timeline.append(len(self._var_change_events), value)
+                self._var_change_events.append(event)
+            if diff.action == Action.CALL:
                 event = Event(EventType.FUNC_CALL\
-                        ,func_name,str(line),func,file,self._state_machine._exec_point)
+                        ,next_diff.func_name,line,func,file,exec_point,diff.depth)
                 self._func_call_events.append(event)
 
+            # step forward like the state machine, skipping implicit returns
+            exec_point += 1
+            diff = next_diff
+            if exec_point < last and diffs[exec_point + 1].action == Action.RET:
+                exec_point += 1
+                diff = diffs[exec_point]
 
-            self._state_machine.forward()
-        #  print(f"var_change_events: {self._var_change_events}")
-        #  print(f"func_call_events: {self._func_call_events}")
-        #  print(f"break_hit_event: {self._break_hit_events}")
+    def _breakpoint_key(self, bp):
+        if bp.breakpoint_type == BPType.FUNC:
+            # going forward, function breakpoints are hit at their first line
+            return (bp.id, bp.abs_filename, bp.startline, None)
+        return (bp.id, bp.abs_filename, bp.lineno, bp.condition)
 
+    def _find_break_hits(self, bp, key):
+        """ return the exec points at which the given breakpoint is hit """
+        id, file_name, lineno, condition = key
+        exec_points = [
+            exec_point
+            for exec_point in self._state_machine.exec_points_at(
+                file_name, lineno
+            )
+            if self._stop_points[exec_point]
+        ]
+        if not condition:
+            return exec_points
+        hits = []
+        for exec_point in exec_points:
+            self._state_machine.seek(exec_point)
+            if bp.eval_condition(self._state_machine.curr_state):
+                hits.append(exec_point)
+        return hits
 
-    def _check_breakpoint_hit(self):
-        """ return breakpoint ids that got hit at the current diff """
-        return self.get_ids_of_current_breaks()
+    def _record_break_hits(self, breakpoints):
+        """ update the break hit events to the given breakpoints """
+        breakpoints = [bp for bp in breakpoints if bp.active]
+        keys = [self._breakpoint_key(bp) for bp in breakpoints]
+        if keys == self._break_keys:
+            return
+        hits = []
+        for bp, key in zip(breakpoints, keys):
+            if key not in self._break_hits:
+                self._break_hits[key] = self._find_break_hits(bp, key)
+            hits.extend((exec_point, bp.id) for exec_point in self._break_hits[key])
+        # forget the hits of breakpoints that were removed
+        self._break_hits = {key: self._break_hits[key] for key in keys}
+        self._break_keys = keys
 
-    def _check_var_changes(self):
-        """ return variables that changed for the current diff """
-        return [ str(x) for x in self.next_diff.changed.keys() ]
-
-    def _check_func_call(self):
-        """ check if a function got called at the current exec point and return
-        the functions name if so """
-        if self.curr_diff.action == Action.CALL:
-            return self.next_diff.func_name 
-        else:
-            return None
+        self._break_hit_events = EventIndex()
+        for exec_point, id in sorted(hits):
+            diff = self._diffs[exec_point]
+            event = Event(EventType.BREAK_HIT\
+                    ,str(id),str(diff.lineno),diff.func_name,diff.file_name\
+                    ,exec_point,diff.depth)
+            self._break_hit_events.append(event)
@@ -1,81 +1,836 @@
+import collections
+import dis
+import functools
 import inspect
+import itertools
 import sys
 import os
+import shutil
+import signal
+import tempfile
+import threading
+import time
 import traceback 
+import weakref
+from array import array
+from fnmatch import fnmatch
 
-from copy import deepcopy
 from typing import List
 
 from ..model.exec_state_diff import ExecStateDiff, Action
+from ..model.snapshot import LocalsSnapshot, DEFAULT_MAX_VALUE_SIZE, value_size
+from ..model.columnar_trace import ColumnarTrace
+from ..model.trace_file import TraceWriter, TraceFileError, load_trace
+from ..model.thread_trace import ThreadTrace
+from ..model.trace_window import TraceWindow
+from .debugger import FunctionStates
+
+GENERATOR_FLAGS = (
+    inspect.CO_GENERATOR | inspect.CO_COROUTINE | inspect.CO_ASYNC_GENERATOR
+)
+YIELD_VALUE = dis.opmap["YIELD_VALUE"]
+
+# sys.monitoring (PEP 669) is only available since python 3.12
+MONITORING = getattr(sys, "monitoring", None)
+
+# names of the asyncio tasks on python 3.7, which has no task names
+_TASK_NAMES = weakref.WeakKeyDictionary()
+_TASK_COUNTER = itertools.count(1)
+
+# directory of the time_travel_debugger package
+PACKAGE_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ""
+)
+
+
+@functools.lru_cache(maxsize=1024)
+def _same_line(code, offset, destination):
+    """ Return whether both bytecode offsets of the code are in one line """
+
+    def line(at):
+        for start, end, lineno in code.co_lines():
+            if start <= at < end:
+                return lineno
+        return None
+
+    return line(offset) == line(destination)
+
+
+def step_size(diff):
+    """Estimate how much memory a step takes, including the values of the
+    variables it changed, but not the objects nested in them"""
+    return (
+        sys.getsizeof(diff)
+        + sum(value_size(value) for value in diff.added.values())
+        + sum(value_size(update.after) for update in diff.updated.values())
+    )
 
 
 class TimeTravelTracer(object):
 
-    NO_TRACE = ["__exit__", "get_trace"]
+    NO_TRACE = [
+        "__exit__",
+        "get_trace",
+        "_stop_monitoring",
+        "_stop_recording",
+        "_start_process",
+    ]
 
-    def __init__(self):
-        self._diffs: List[ExecStateDiff] = []
+    # steps kept before the start trigger fires, if neither keep_last nor
+    # keep_size is given
+    TRIGGER_KEEP_LAST = 100
+
+    def __init__(
+        self,
+        max_value_size=DEFAULT_MAX_VALUE_SIZE,
+        columnar=False,
+        trace_file=None,
+        sample_every=None,
+        sample_interval=None,
+        include=None,
+        exclude=None,
+        backend="settrace",
+        threads=False,
+        processes=False,
+        keep_last=None,
+        keep_size=None,
+        start_at=None,
+        stop_at=None,
+    ):
+        # with start_at, a Trigger like FunctionTrigger("parse"), only the
+        # last steps before the trigger fires are kept, as by a flight
+        # recorder with keep_last=TRIGGER_KEEP_LAST by default. Until then
+        # lines are recorded without their variables, like unsampled lines,
+        # afterwards everything is recorded. With stop_at the recording
+        # stops after the event at which that trigger fires.
+        self._start_at = start_at
+        self._stop_at = stop_at
+        if start_at is not None and keep_last is None and keep_size is None:
+            keep_last = self.TRIGGER_KEEP_LAST
+        # with keep_last or keep_size the tracer is a flight recorder, that
+        # only keeps the last keep_last steps, or the last steps that take
+        # about keep_size bytes. The steps it drops are folded into _base,
+        # the scopes of the active functions at the first step it keeps.
+        self._keep_last = keep_last
+        self._keep_size = keep_size
+        self._flight_recorder = keep_last is not None or keep_size is not None
+        if self._flight_recorder and (
+            trace_file or columnar or threads or processes
+        ):
+            raise ValueError(
+                "A flight recorder can't record columnar, into a trace file, "
+                "threads or processes"
+            )
+        self._base = FunctionStates(remember_returns=False)
+        # whether old steps are still dropped, a triggered recording keeps
+        # all steps once the trigger fired
+        self._drop_steps = self._flight_recorder
+        # True while we wait for the start trigger
+        self._armed = start_at is not None
+        # the trigger we wait for
+        self._trigger = start_at if start_at is not None else stop_at
+        # True if the stop trigger ended the recording
+        self._stopped = False
+        # index of the first step recorded after the start trigger fired
+        self._trigger_point = None
+        # estimated size of the steps the flight recorder keeps, in bytes
+        self._size = 0
+        # the recorded diffs, either as list, in a more compact ColumnarTrace
+        # or streamed to a trace file, which are all used in the same way
+        if self._flight_recorder:
+            self._diffs = collections.deque()
+        elif trace_file:
+            self._diffs = TraceWriter(trace_file)
+        elif columnar:
+            self._diffs = ColumnarTrace()
+        else:
+            self._diffs: List[ExecStateDiff] = []
+        # the diff we recorded last, new diffs are derived from it
+        self._last_diff = None
         self._source_map = {}
+        # maps code objects to their entry in the source map, so we only have
+        # to ask inspect once per code object
+        self._source_cache = {}
+        # stack of LocalsSnapshots, one for each active function
         self._last_vars = []
+        # values larger than this (in bytes) are stored as truncated repr
+        self._max_value_size = max_value_size
         self._should_call = False
+        # whether the call we postponed resumes a generator or coroutine
+        self._resumed = False
         self._root_func_name = ""
+        # in sampling mode only every sample_every-th line, or the first line
+        # after sample_interval milliseconds, records the variables. Other
+        # lines only record their line number. Calls and returns are always
+        # recorded in full.
+        self._sample_every = sample_every
+        self._sample_interval = (
+            sample_interval / 1000 if sample_interval else None
+        )
+        self._sampling = bool(sample_every or sample_interval)
+        self._lines_since_sample = 0
+        self._last_sample_time = time.perf_counter()
+        # unsampled diffs of the function we are in, by line number
+        self._line_diffs_frame = None
+        self._line_diffs = {}
+        # glob patterns like "mypackage.*", "*/site-packages/*" or "test_*",
+        # matched against the module name, file path and function name of a
+        # frame. Only frames that match an include pattern (if there are
+        # any) and no exclude pattern are recorded.
+        self._include = list(include or [])
+        self._exclude = list(exclude or [])
+        # whether the frames of a code object are recorded, by code object
+        self._in_scope_cache = {}
+        # "settrace" or "monitoring". sys.monitoring only reports the events
+        # of the code we record to us, on older interpreters we fall back to
+        # settrace.
+        if backend not in ("settrace", "monitoring"):
+            raise ValueError(f"Invalid backend: '{backend}'")
+        # sys.monitoring reports the events of all threads to the same
+        # callbacks, so threads are always recorded with settrace
+        self._monitoring = (
+            backend == "monitoring" and MONITORING is not None and not threads
+        )
+        # code objects we enabled the local monitoring events for
+        self._monitored_code = set()
+        # python frames of the recorded functions that are active, events of
+        # other frames of the same code objects are ignored
+        self._frames = []
+        # frame of the generator or coroutine resumed last, if nothing else
+        # happened in it since
+        self._resumed_frame = None
+        # with threads, the threads started while recording are recorded as
+        # well, each by an own ThreadTracer. The steps of all threads are
+        # numbered by a shared logical clock, the clock of each of our diffs
+        # is in _clocks.
+        self._record_threads = threads
+        if processes:
+            # the monotonic clock is the same in all processes
+            self._clock = iter(time.monotonic_ns, None)
+        elif threads:
+            self._clock = itertools.count()
+        else:
+            self._clock = None
+        self._clocks = array("q")
+        self._recording = False
+        self._thread_tracers = []
+        self._threads_lock = threading.Lock()
+        self._thread_name = ""
+        # thread tracers record in memory, they can't share the trace file
+        self._thread_options = {
+            "max_value_size": max_value_size,
+            "columnar": columnar or bool(trace_file),
+            "sample_every": sample_every,
+            "sample_interval": sample_interval,
+            "include": include,
+            "exclude": exclude,
+        }
+        # with processes, the processes started while recording are
+        # recorded as well, each by a ProcessTracer that writes a trace file
+        # to the directory processes (a temporary directory if it is True).
+        # Their traces are timelines like the ones of threads.
+        self._record_processes = bool(processes)
+        self._process_dir = processes if isinstance(processes, str) else None
+        # whether we created _process_dir, then it is removed when the
+        # traces in it are loaded
+        self._temporary_process_dir = False
+        self._process_options = {
+            **self._thread_options,
+            "backend": backend,
+        }
+        # BaseProcess.start, while we replace it
+        self._start_process = None
+        # time at which the recording started
+        self._start_clock = None
+        # ThreadTraces of all recorded threads and processes, set by
+        # get_trace
+        self._threads = []
 
     def get_trace(self):
-        sys.settrace(None)
-        # insert empty state at the beginning to mark the start
-        self._diffs.insert(0,ExecStateDiff(self.root_func_name))
-        # remove implicit return statement
-        self._diffs.pop()
-        return self._diffs, self._source_map
+        if self._recording:
+            self._stop_recording()
+        # remove implicit return statement, which is not there if the stop
+        # trigger ended the recording
+        if self._diffs and not self._stopped:
+            self._pop()
+        if isinstance(self._diffs, TraceWriter):
+            # finish the trace file and read the trace back from it
+            diffs, source_map = load_trace(
+                self._diffs.close(
+                    self._source_map,
+                    self._clocks if self._clock is not None else None,
+                ),
+                trusted=True,
+            )
+        elif self._flight_recorder:
+            diffs = self._window()
+            source_map = self._source_map
+        else:
+            diffs, source_map = self._diffs, self._source_map
+        if self._record_threads or self._record_processes:
+            self._threads = [
+                ThreadTrace(0, self._thread_name, diffs, self._clocks)
+            ]
+            for tracer in self._thread_tracers:
+                thread_trace = tracer.thread_trace()
+                if not thread_trace.diffs:
+                    # the thread did not run any code we record
+                    continue
+                self._threads.append(thread_trace)
+                source_map.update(tracer._source_map)
+            self._threads.extend(self._process_traces(source_map))
+        return diffs, source_map
+
+    def dump(self):
+        """Return the steps the flight recorder kept so far and the source
+        map, like get_trace, while the recording goes on"""
+        if not self._flight_recorder:
+            raise ValueError("Only a flight recorder can be dumped")
+        return (
+            self._window(),
+            self._source_map.copy(),
+        )
+
+    def _window(self):
+        return TraceWindow(
+            self._diffs, self._base.checkpoint(), self._trigger_point
+        )
+
+    def pause(self):
+        """Stop recording until resume is called, e.g. while the steps
+        recorded so far are inspected"""
+        if self._monitoring:
+            MONITORING.set_events(
+                MONITORING.DEBUGGER_ID, MONITORING.events.NO_EVENTS
+            )
+        else:
+            sys.settrace(None)
+
+    def resume(self):
+        """ Continue a recording that was paused """
+        if self._monitoring:
+            MONITORING.set_events(
+                MONITORING.DEBUGGER_ID, self._global_monitoring_events()
+            )
+        else:
+            sys.settrace(self._traceit)
+
+    def _stop_recording(self):
+        self._recording = False
+        if self._monitoring:
+            self._stop_monitoring()
+        else:
+            sys.settrace(None)
+        if self._record_threads:
+            threading.settrace(None)
+        if self._start_process is not None:
+            BaseProcess = sys.modules["multiprocessing.process"].BaseProcess
+            BaseProcess.start = self._start_process
+            self._start_process = None
+
+    @property
+    def triggered(self):
+        """Whether the start trigger fired, always True without one"""
+        return not self._armed
+
+    def _process_traces(self, source_map):
+        """Load the traces of the processes started while recording as
+        ThreadTraces, in the order the processes started"""
+        if not self._record_processes:
+            return []
+        traces = []
+        for file_name in os.listdir(self._process_dir):
+            if not file_name.endswith(".trace"):
+                continue
+            try:
+                diffs, process_source_map = load_trace(
+                    os.path.join(self._process_dir, file_name), trusted=True
+                )
+            except TraceFileError:
+                # the process was killed before it finished its trace
+                continue
+            if not diffs or diffs.clocks[0] < self._start_clock:
+                # nothing was recorded, or the trace is from an earlier
+                # recording into the same directory
+                continue
+            pid, name = file_name[: -len(".trace")].split("-", 1)
+            traces.append((diffs, f"{name} (pid {pid})"))
+            source_map.update(process_source_map)
+        if self._temporary_process_dir:
+            # the loaded traces stay mapped after their files are removed
+            # (except on Windows, where they are left behind)
+            shutil.rmtree(self._process_dir, ignore_errors=True)
+        traces.sort(key=lambda trace: trace[0].clocks[0])
+        return [
+            ThreadTrace(id, name, diffs, diffs.clocks)
+            for id, (diffs, name) in enumerate(
+                traces, start=len(self._thread_tracers) + 1
+            )
+        ]
+
+    @property
+    def threads(self):
+        """ThreadTraces of all recorded threads and processes, starting with
+        the thread that started recording. Empty if neither threads nor
+        processes are recorded."""
+        return self._threads
 
     def set_trace(self):
-        sys.settrace(self._traceit)
+        self._recording = True
+        self._thread_name = threading.current_thread().name
+        if self._record_threads:
+            threading.settrace(self._trace_thread)
+        if self._record_processes:
+            self._record_started_processes()
+        if self._monitoring:
+            try:
+                MONITORING.use_tool_id(
+                    MONITORING.DEBUGGER_ID, "time travel debugger"
+                )
+            except ValueError:
+                # another debugger is using sys.monitoring
+                self._monitoring = False
+        if self._monitoring:
+            self._start_monitoring()
+        else:
+            sys.settrace(self._traceit)
+
+    def _record_started_processes(self):
+        """Replace BaseProcess.start until the recording stops, so every
+        process that is started runs with a ProcessTracer. This works for
+        all start methods, since the process object is either copied by
+        fork or pickled and sent to the new process."""
+        # multiprocessing is only imported if processes are recorded
+        from multiprocessing.process import BaseProcess
+
+        if self._process_dir is None:
+            self._process_dir = tempfile.mkdtemp(prefix="time-travel-")
+            self._temporary_process_dir = True
+        else:
+            os.makedirs(self._process_dir, exist_ok=True)
+        self._start_clock = next(self._clock)
+        start = self._start_process = BaseProcess.start
+        recorded_run = functools.partial(
+            RecordedRun,
+            parent=self,
+            directory=self._process_dir,
+            options=self._process_options,
+        )
+
+        def _start_process(process):
+            process.run = recorded_run(process.run)
+            try:
+                start(process)
+            finally:
+                del process.run
+
+        BaseProcess.start = _start_process
+
+    def _trace_thread(self, frame, event, arg):
+        """Trace function of the threads started while recording, which
+        records the thread from now on with an own tracer"""
+        with self._threads_lock:
+            tracer = ThreadTracer(
+                self,
+                len(self._thread_tracers) + 1,
+                threading.current_thread().name,
+                **self._thread_options,
+            )
+            self._thread_tracers.append(tracer)
+        sys.settrace(tracer._traceit)
+        return tracer._traceit(frame, event, arg)
+
+    def _start_monitoring(self):
+        """Record with sys.monitoring. Calls, resumes and exceptions are
+        reported for all code, lines and returns only for the code objects
+        we record. Code we don't record is disabled on its first call, so it
+        runs without any overhead afterwards."""
+        events = MONITORING.events
+        tool = MONITORING.DEBUGGER_ID
+        for event, callback in (
+            (events.PY_START, self._monitor_start),
+            (events.PY_RESUME, self._monitor_resume),
+            (events.LINE, self._monitor_line),
+            (events.JUMP, self._monitor_jump),
+            (events.PY_RETURN, self._monitor_return),
+            (events.PY_YIELD, self._monitor_return),
+            (events.PY_UNWIND, self._monitor_unwind),
+            (events.RAISE, self._monitor_raise),
+        ):
+            MONITORING.register_callback(tool, event, callback)
+        MONITORING.set_events(tool, self._global_monitoring_events())
+
+    @staticmethod
+    def _global_monitoring_events():
+        events = MONITORING.events
+        return (
+            events.PY_START | events.PY_RESUME | events.PY_UNWIND | events.RAISE
+        )
+
+    def _stop_monitoring(self):
+        events = MONITORING.events
+        tool = MONITORING.DEBUGGER_ID
+        MONITORING.set_events(tool, events.NO_EVENTS)
+        for code in self._monitored_code:
+            MONITORING.set_local_events(tool, code, events.NO_EVENTS)
+        for event in (
+            events.PY_START,
+            events.PY_RESUME,
+            events.LINE,
+            events.JUMP,
+            events.PY_RETURN,
+            events.PY_YIELD,
+            events.PY_UNWIND,
+            events.RAISE,
+        ):
+            MONITORING.register_callback(tool, event, None)
+        # enable the code we disabled again, for other tools
+        MONITORING.restart_events()
+        MONITORING.free_tool_id(tool)
+        self._monitored_code = set()
+        self._frames = []
+        self._resumed_frame = None
+
+    # The monitoring callbacks are called by the interpreter right from the
+    # frame the event happened in, so sys._getframe(1) is that frame. They
+    # translate the events to the ones of settrace.
+
+    def _monitor_start(self, code, offset):
+        return self._start_frame(sys._getframe(1), code)
+
+    def _monitor_resume(self, code, offset):
+        frame = sys._getframe(1)
+        result = self._start_frame(frame, code)
+        if self._frames and frame is self._frames[-1]:
+            # settrace reports the line a resumed generator or coroutine
+            # continues in right after the call, sys.monitoring only reports
+            # the lines after it. Report it as well, so the call is recorded
+            # at that line and both backends record the same steps.
+            self._traceit(frame, "line", None)
+            self._resumed_frame = frame
+        return result
+
+    def _start_frame(self, frame, code):
+        if code.co_name in self.NO_TRACE or not self._in_scope(frame):
+            # we are never called for this code again
+            return MONITORING.DISABLE
+        if code not in self._monitored_code:
+            events = MONITORING.events
+            MONITORING.set_local_events(
+                MONITORING.DEBUGGER_ID,
+                code,
+                events.LINE | events.JUMP | events.PY_RETURN | events.PY_YIELD,
+            )
+            self._monitored_code.add(code)
+        self._frames.append(frame)
+        self._traceit(frame, "call", None)
+
+    def _monitor_line(self, code, line_number):
+        frame = sys._getframe(1)
+        self._resumed_frame = None
+        if self._frames and frame is self._frames[-1]:
+            self._traceit(frame, "line", None)
+
+    def _monitor_jump(self, code, offset, destination):
+        # settrace reports the line again at every backward jump, LINE only
+        # if the line changes. Report the loops that stay on one line, like
+        # comprehensions, the other jumps are disabled on their first call.
+        if destination > offset or not _same_line(code, offset, destination):
+            return MONITORING.DISABLE
+        frame = sys._getframe(1)
+        if frame is self._resumed_frame:
+            # a generator that loops back right after it was resumed, like
+            # a generator expression, the line was reported on the resume
+            self._resumed_frame = None
+            return None
+        if self._frames and frame is self._frames[-1]:
+            self._traceit(frame, "line", None)
+
+    def _monitor_return(self, code, offset, retval):
+        self._monitor_leave(sys._getframe(1), retval)
+
+    def _monitor_unwind(self, code, offset, exception):
+        # the frame is left because of an exception, which settrace reports
+        # as a return without a value
+        self._monitor_leave(sys._getframe(1), None)
+
+    def _monitor_leave(self, frame, retval):
+        self._resumed_frame = None
+        if self._frames and frame is self._frames[-1]:
+            self._frames.pop()
+            self._traceit(frame, "return", retval)
+
+    def _monitor_raise(self, code, offset, exception):
+        frame = sys._getframe(1)
+        if self._frames and frame is self._frames[-1]:
+            self._traceit(
+                frame,
+                "exception",
+                (type(exception), exception, exception.__traceback__),
+            )
+
+    def _in_scope(self, frame):
+        """ Return whether the frame should be recorded """
+        code = frame.f_code
+        try:
+            return self._in_scope_cache[code]
+        except KeyError:
+            names = (
+                frame.f_globals.get("__name__", ""),
+                code.co_filename,
+                code.co_name,
+            )
+
+            def matches(patterns):
+                return any(
+                    fnmatch(name, pattern)
+                    for pattern in patterns
+                    for name in names
+                )
+
+            # the debugger itself is never recorded
+            in_scope = (
+                not code.co_filename.startswith(PACKAGE_DIR)
+                and (not self._include or matches(self._include))
+                and not matches(self._exclude)
+            )
+            self._in_scope_cache[code] = in_scope
+            return in_scope
+
+    def _recorded_caller(self, frame):
+        """Return the frame of the nearest caller we record, or None. The
+        callers in between are not recorded, e.g. because they are excluded
+        from the scope."""
+        caller = frame.f_back
+        while caller is not None and (
+            caller.f_code.co_name in self.NO_TRACE or not self._in_scope(caller)
+        ):
+            caller = caller.f_back
+        return caller
 
     def _traceit(self, frame, event, arg):
         """ Internal tracing method """
+        if event == "call" and not self._in_scope(frame):
+            # without a local trace function python doesn't report the lines
+            # of the frame to us at all
+            return None
         # Don't trace __exit__ function and get_trace
         if frame.f_code.co_name not in self.NO_TRACE:
-            self.traceit(frame, event, arg)
+            stop = False
+            trigger = self._trigger
+            if trigger is not None and trigger.fires(frame, event, arg):
+                if self._armed:
+                    self._start_capture(frame, event)
+                else:
+                    stop = True
+            if (
+                event == "line"
+                and not self._should_call
+                and (self._armed or self._sampling and not self._sample())
+            ):
+                # unsampled lines are recorded as fast as possible, they only
+                # happen in functions we already know
+                self._do_line(frame)
+            else:
+                self.traceit(frame, event, arg)
+            if stop:
+                self._stop_capture()
+                return None
         return self._traceit
 
+    def _start_capture(self, frame, event):
+        """The start trigger fired, record everything from now on"""
+        self._armed = False
+        self._drop_steps = False
+        self._trigger = self._stop_at
+        last_diff = self._last_diff
+        if (
+            event == "exception"
+            and not self._should_call
+            and last_diff is not None
+            and last_diff.action == Action.LINE
+        ):
+            # the line that raised was not recorded with its variables
+            self._pop()
+            self._do_update(frame)
+            self._trigger_point = len(self._diffs) - 1
+        else:
+            # the marker at the start is recorded after this if nothing was
+            self._trigger_point = len(self._diffs) or 1
+
+    def _stop_capture(self):
+        """The stop trigger fired, nothing is recorded anymore"""
+        self._trigger = None
+        self._stopped = True
+        self._stop_recording()
+
+    def _append(self, diff):
+        self._diffs.append(diff)
+        self._last_diff = diff
+        if self._clock is not None:
+            self._clocks.append(next(self._clock))
+        if self._drop_steps:
+            self._drop_old_steps(diff)
+
+    def _pop(self):
+        diff = self._diffs.pop()
+        if self._clock is not None:
+            self._clocks.pop()
+        if self._keep_size is not None:
+            self._size -= step_size(diff)
+
+    def _drop_old_steps(self, diff):
+        """ Drop the oldest steps the flight recorder does not keep anymore """
+        diffs = self._diffs
+        if self._keep_size is not None:
+            self._size += step_size(diff)
+        # the first step, whose state is _base, and the last one are kept
+        while len(diffs) > 2 and (
+            (self._keep_last is not None and len(diffs) > self._keep_last + 1)
+            or (self._keep_size is not None and self._size > self._keep_size)
+        ):
+            dropped = diffs.popleft()
+            if self._keep_size is not None:
+                self._size -= step_size(dropped)
+            self._base.apply(diffs[0])
+
     def _exception(self,tb):
         new_state = self._current_diff.exception(tb)
-        self._diffs.append(new_state)
+        self._append(new_state)
 
 
     def _do_return(self, frame):
         # return statements also could update variables:
         self._do_update(frame)
         new_state = self._current_diff.ret()
-        self._diffs.append(new_state)
+        self._append(new_state)
         self._last_vars.pop()
         #  print(f"RETURN")
 
-    def _do_call(self, frame):
+    def _do_call(self, frame, filename):
         #  self._diffs.pop()
         # we called a new function, so setup a new scope of variables
-        # set last_frame manually since we don't compute _changed_vars
         # create new function frame in current _exec_state_diff
-        new_state = self._current_diff.call(frame)
-        self._diffs.append(new_state)
-        locals = frame.f_locals.copy()
-        self._last_vars.append(locals)
+        snapshot = LocalsSnapshot(self._max_value_size)
+        params, _ = snapshot.update(frame.f_locals)
+        new_state = self._current_diff.call(
+            frame, filename, params, self._current_task(), self._resumed
+        )
+        self._append(new_state)
+        self._last_vars.append(snapshot)
         #  print(f"CALL")
 
-    def _do_update(self, frame):
-        # save old scope for the update on _exec_state_diff
-        #  prev_vars = self._last_vars[-1]
-        #  changed = self._changed_vars(frame.f_locals.copy())
-        #  added = self._added_vars(frame.f_locals.copy())
-        # new function, invoke in exec_state_diff accordingly
-        new_state = self._current_diff.update(
-            frame, deepcopy(self._last_vars[-1]), frame.f_locals.copy()
+    @staticmethod
+    def _current_task():
+        """Return the name of the asyncio task that is running, or None"""
+        # asyncio is only imported by programs that use it
+        asyncio = sys.modules.get("asyncio")
+        if asyncio is None:
+            return None
+        loop = asyncio._get_running_loop()
+        if loop is None:
+            return None
+        task = asyncio.current_task(loop)
+        if task is None:
+            return None
+        get_name = getattr(task, "get_name", None)
+        if get_name is not None:
+            return get_name()
+        # tasks have no names before python 3.8, so number them in the order
+        # we see them, like python does
+        try:
+            return _TASK_NAMES[task]
+        except KeyError:
+            name = _TASK_NAMES[task] = f"Task-{next(_TASK_COUNTER)}"
+            return name
+
+    @staticmethod
+    def _is_resumed(frame):
+        """Return whether the call event of the frame resumes a suspended
+        generator or coroutine, which then continues right after the yield
+        it was suspended at"""
+        code = frame.f_code
+        if not code.co_flags & GENERATOR_FLAGS or frame.f_lasti < 0:
+            return False
+        if sys.version_info < (3, 11):
+            # before python 3.11 a frame that was not started yet has no last
+            # instruction, a suspended one is at its yield (or before the
+            # YIELD_FROM of an await)
+            return True
+        # since python 3.11 a frame starts at its first RESUME instruction,
+        # a suspended one is at the RESUME that follows its yield
+        return YIELD_VALUE in code.co_code[
+            max(frame.f_lasti - 2, 0) : frame.f_lasti + 1 : 2
+        ]
+
+    @staticmethod
+    def _is_internal_stop(frame, arg):
+        """Return whether the exception event is the StopIteration a
+        generator or coroutine raises when it is done, which is not raised
+        by the program itself"""
+        return (
+            frame.f_code.co_flags & GENERATOR_FLAGS
+            and arg[0] is StopIteration
+            and arg[2] is None
         )
-        self._diffs.append(new_state)
-        locals = frame.f_locals.copy()
-        self._last_vars[-1] = locals
+
+    def _do_update(self, frame):
+        # only the variables that changed since the last snapshot are copied
+        added, updated = self._last_vars[-1].update(frame.f_locals)
+        new_state = self._current_diff.update(frame, added, updated)
+        self._append(new_state)
         #  print(f"UPDATE")
 
+    def _do_line(self, frame):
+        # the variables of the line are not recorded. Diffs are never
+        # modified, so all unsampled diffs of a line in the current function
+        # are the same diff, and we only create it once.
+        last_diff = self._last_diff
+        if last_diff.frame is not self._line_diffs_frame:
+            self._line_diffs_frame = last_diff.frame
+            self._line_diffs = {}
+        try:
+            new_state = self._line_diffs[frame.f_lineno]
+        except KeyError:
+            new_state = self._line_diffs[frame.f_lineno] = last_diff.line(frame)
+        self._diffs.append(new_state)
+        self._last_diff = new_state
+        if self._clock is not None:
+            self._clocks.append(next(self._clock))
+        if self._drop_steps:
+            self._drop_old_steps(new_state)
+
+    def _sample(self):
+        """ Return whether the variables of the next line should be recorded """
+        self._lines_since_sample += 1
+        if self._sample_every and self._lines_since_sample >= self._sample_every:
+            sample = True
+        elif self._sample_interval:
+            now = time.perf_counter()
+            sample = now - self._last_sample_time >= self._sample_interval
+        else:
+            sample = False
+        if sample:
+            self._lines_since_sample = 0
+            self._last_sample_time = time.perf_counter()
+        return sample
+
+    def _get_source(self, code):
+        """Return the source map entry of a code object. File name and source
+        lines are only resolved the first time we see the code object."""
+        try:
+            return self._source_cache[code]
+        except KeyError:
+            filename = inspect.getsourcefile(code)
+            lines, startline = inspect.getsourcelines(code)
+            source = {
+                "start": startline,
+                "code": lines,
+                "filename": filename,
+            }
+            self._source_cache[code] = source
+            return source
+
     @property
     def root_func_name(self):
         return self._root_func_name
@@ -87,10 +842,9 @@ class TimeTravelTracer(object):
 
     @property
     def _current_diff(self):
-        if len(self._diffs) > 0:
-            return deepcopy(self._diffs[-1])
-        else:
-            return ExecStateDiff(self._root_func_name)
+        # diffs are never modified once they are recorded, new diffs are
+        # derived from the last one, so there is no need to copy it
+        return self._last_diff
 
     def traceit(self, frame, event, arg):
         """Record the execution inside the with block.
@@ -102,15 +856,13 @@ class TimeTravelTracer(object):
 
         # collect the code in a source_map, so we can print it later in the
         # debugger
-        filename = inspect.getsourcefile(frame.f_code)
-        code, startline = inspect.getsourcelines(frame.f_code)
-        self.root_func_name = frame.f_code.co_name
-        #  if frame.f_code.co_name not in self._source_map:
-        self._source_map[frame.f_code.co_name] = {
-            "start": startline,
-            "code": code,
-            "filename": filename,
-        }
+        code = frame.f_code
+        source = self._get_source(code)
+        self.root_func_name = code.co_name
+        self._source_map[code.co_name] = source
+        if self._last_diff is None:
+            # insert empty state at the beginning to mark the start
+            self._append(ExecStateDiff(self.root_func_name))
         #  print(f"{frame.f_lineno}: {code[frame.f_lineno - startline]}")
         #  print(f"EVENT:{event}")
         #  print(f"last_vars:{self._last_vars}")
@@ -122,10 +874,35 @@ class TimeTravelTracer(object):
             # function definition
             # In order to get rid of this, we always ignore the line where a
             # call happens and postpone this call to one line later
+            if self._should_call:
+                # our caller was resumed (it is a generator or coroutine) and
+                # called us before it reached a new line, so we have to
+                # record its call first
+                caller = self._recorded_caller(frame)
+                if caller is not None:
+                    self._do_call(
+                        caller, self._get_source(caller.f_code)["filename"]
+                    )
             self._should_call = True
+            self._resumed = self._is_resumed(frame)
+            if self._last_diff.action == Action.LINE:
+                # the caller was not sampled at the line of the call, record
+                # its variables now, so its state is exact when we return
+                caller = self._recorded_caller(frame)
+                if caller is not None and self._last_diff.frame.frame == hash(
+                    caller
+                ):
+                    self._pop()
+                    self._do_update(caller)
+        elif self._should_call and event == "line":
+            self._do_call(frame, source["filename"])
+            self._should_call = False
         elif self._should_call:
-            self._do_call(frame)
+            # a resumed generator or coroutine can be suspended again or raise
+            # before it reaches a new line, the call has to be recorded anyway
+            self._do_call(frame, source["filename"])
             self._should_call = False
+            return self.traceit(frame, event, arg)
         elif event == "line":
             self._do_update(frame)
             #  print(f"UPDATE")
@@ -134,7 +911,10 @@ class TimeTravelTracer(object):
             self._do_return(frame)
             #  print(f"RETURN")
         elif event == "exception" :
-            print("exception")
+            if self._is_internal_stop(frame, arg):
+                # a generator or coroutine finished and raised StopIteration
+                # to its caller, this is not an exception of the program
+                return self._traceit
             exception, value, tb = arg
             #  print(arg)
             tb = traceback.format_exception(exception, value, tb)
@@ -144,3 +924,97 @@ class TimeTravelTracer(object):
 
         # print(f"vars:{self._diffs[-1]}")
         return self._traceit
+
+
+class ThreadTracer(TimeTravelTracer):
+    """Records one of the threads started while a TimeTravelTracer records
+    threads, with the options and the logical clock of that tracer"""
+
+    def __init__(self, parent, id, name, **options):
+        super().__init__(**options)
+        self._parent = parent
+        self._id = id
+        self._name = name
+        self._clock = parent._clock
+
+    def _traceit(self, frame, event, arg):
+        if not self._parent._recording:
+            # the recording ended, don't trace this thread anymore
+            sys.settrace(None)
+            return None
+        return super()._traceit(frame, event, arg)
+
+    def thread_trace(self):
+        """ Return the ThreadTrace of what the thread did so far """
+        diffs = self._diffs
+        if diffs and diffs[-1].action == Action.RET and diffs[-1].frame is None:
+            # remove the return from the run method of the thread, like the
+            # implicit return at the end of the main trace
+            self._pop()
+        return ThreadTrace(self._id, self._name, diffs, self._clocks)
+
+
+class ProcessTracer(TimeTravelTracer):
+    """Records a process started while a TimeTravelTracer records
+    processes, into a trace file in the directory of the traces of the
+    processes. The processes it starts are recorded as well."""
+
+    def __init__(self, directory, **options):
+        from multiprocessing import current_process
+
+        # the file name tells the tracer that merges the traces which
+        # process it belongs to
+        name = current_process().name.replace(os.sep, "_")
+        super().__init__(
+            trace_file=os.path.join(directory, f"{os.getpid()}-{name}.trace"),
+            processes=directory,
+            **options,
+        )
+
+    def _process_traces(self, source_map):
+        # the traces of all processes are merged by the tracer that started
+        # the recording
+        return []
+
+
+class RecordedRun(object):
+    """Replaces the run method of a process started while recording
+    processes, it runs the original one with a ProcessTracer"""
+
+    def __init__(self, run, parent, directory, options):
+        self._run = run
+        self._parent = parent
+        self._directory = directory
+        self._options = options
+
+    def __getstate__(self):
+        # the tracer that started the process stays in that process
+        state = self.__dict__.copy()
+        state["_parent"] = None
+        return state
+
+    def __call__(self):
+        if self._parent is not None:
+            # the process was forked, so the tracer of the parent process
+            # is still recording in this process
+            self._parent._stop_recording()
+        terminated = []
+        if signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+            # terminate() (e.g. of a Pool when its with block ends) kills the
+            # process with SIGTERM, so let it exit normally instead, write
+            # the trace and kill it afterwards
+
+            def terminate(signum, frame):
+                terminated.append(signum)
+                sys.exit()
+
+            signal.signal(signal.SIGTERM, terminate)
+        tracer = ProcessTracer(self._directory, **self._options)
+        tracer.set_trace()
+        try:
+            return self._run()
+        finally:
+            tracer.get_trace()
+            if terminated:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                os.kill(os.getpid(), signal.SIGTERM)
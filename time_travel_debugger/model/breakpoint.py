@@ -63,6 +63,11 @@ class Breakpoint(BaseBreakpoint):
         )
         self._lineno = lineno
         self._condition = condition
+        # compile the condition only once, raises a SyntaxError if the
+        # condition is invalid
+        self._code = (
+            compile(condition, "<condition>", "eval") if condition else None
+        )
 
     def __iter__(self):
         return iter(
@@ -79,12 +84,12 @@ class Breakpoint(BaseBreakpoint):
         """Evaluate the condition given in the constructor in the given
         context.  Always returns True if no condition was given."""
         if self.active:
-            if not self.condition:
+            if self._code is None:
                 # We do not have a condition, so we always break
                 return True
             try:
-                return eval(self.condition, context)
-            except:
+                return eval(self._code, context)
+            except Exception:
                 return False
 
     @property
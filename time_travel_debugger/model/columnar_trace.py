@@ -0,0 +1,255 @@
+from array import array
+from bisect import bisect_left
+
+from .exec_state_diff import ExecStateDiff, Action, VarUpdate
+
+# action codes in the action column, 0 marks the start of the trace
+_ACTIONS = {action.value: action for action in Action}
+
+# kinds of variable deltas
+_ADDED = 0
+_UPDATED = 1
+
+# typecodes to widen a column to, once a value does not fit anymore
+_WIDER = {"h": "i", "i": "q"}
+
+
+class ColumnarTrace(object):
+    """Array backed storage for a recorded trace.
+
+    Instead of keeping one ExecStateDiff object per step, the scalar fields
+    of all steps are stored in parallel typed arrays, where the exec point
+    is the index into the arrays. Function and file name and depth are the
+    ones of the frame of a step, they are kept once per frame. Line numbers
+    and frame ids start as 16 bit integers, the columns are widened when a
+    value does not fit.
+
+    The variable deltas of all steps live in one side table. Most steps
+    don't change a variable, so only the steps that do are listed in
+    var_steps, the deltas of var_steps[i] are the entries var_offsets[i] to
+    var_offsets[i + 1].
+
+    The trace behaves like the list of ExecStateDiffs returned by the
+    tracer, indexing it creates the ExecStateDiff of that step on the fly.
+    """
+
+    def __init__(self):
+        self._root_func_name = ""
+
+        # one entry per step
+        self._actions = array("b")
+        self._linenos = array("h")
+        self._frame_ids = array("h")
+
+        # one entry per step that changes variables
+        self._var_steps = array("i")
+        self._var_offsets = array("i", [0])
+
+        # one entry per variable delta
+        self._var_names = array("i")
+        self._var_kinds = array("b")
+        self._var_values = []
+        self._var_befores = []
+
+        # one entry per called function
+        self._frames = []
+        self._frame_index = {}
+        self._frame_func_ids = array("i")
+        self._frame_file_ids = array("i")
+
+        # interned strings
+        self._strings = []
+        self._string_ids = {}
+        # function and file name of the steps without a frame
+        self._no_frame_func_id = self._no_frame_file_id = self._intern("")
+
+        # tracebacks of exception steps
+        self._tracebacks = {}
+
+        # the last few materialized diffs, since the state machine looks at
+        # the same steps over and over again
+        self._cache = {}
+
+    def _intern(self, string):
+        try:
+            return self._string_ids[string]
+        except KeyError:
+            string_id = len(self._strings)
+            self._strings.append(string)
+            self._string_ids[string] = string_id
+            return string_id
+
+    def _frame_id(self, frame):
+        if frame is None:
+            return -1
+        try:
+            return self._frame_index[frame]
+        except KeyError:
+            frame_id = len(self._frames)
+            self._frames.append(frame)
+            self._frame_index[frame] = frame_id
+            self._frame_func_ids.append(self._intern(frame.func_name))
+            self._frame_file_ids.append(self._intern(frame.file_name))
+            return frame_id
+
+    def _append_widened(self, name, value):
+        """ Append a value that does not fit into the typecode of a column """
+        column = getattr(self, name)
+        column = array(_WIDER[column.typecode], column)
+        column.append(value)
+        setattr(self, name, column)
+
+    def append(self, diff):
+        if not self._actions:
+            self._root_func_name = diff.func_name
+            self._no_frame_func_id = self._intern(diff.func_name)
+        action = diff.action
+        self._actions.append(action.value if action is not None else 0)
+        lineno = diff.lineno
+        try:
+            self._linenos.append(lineno)
+        except OverflowError:
+            self._append_widened("_linenos", lineno)
+        frame_id = self._frame_id(diff.frame)
+        try:
+            self._frame_ids.append(frame_id)
+        except OverflowError:
+            self._append_widened("_frame_ids", frame_id)
+
+        if diff.added or diff.updated:
+            self._var_steps.append(len(self._actions) - 1)
+            for name, value in diff.added.items():
+                self._var_names.append(self._intern(name))
+                self._var_kinds.append(_ADDED)
+                self._var_values.append(value)
+                self._var_befores.append(None)
+            for name, update in diff.updated.items():
+                self._var_names.append(self._intern(name))
+                self._var_kinds.append(_UPDATED)
+                self._var_values.append(update.after)
+                self._var_befores.append(update.before)
+            self._var_offsets.append(len(self._var_names))
+
+        if action == Action.EXCEPTION:
+            self._tracebacks[len(self._actions) - 1] = diff._tb
+
+    def extend(self, diffs):
+        for diff in diffs:
+            self.append(diff)
+
+    def pop(self):
+        diff = self[-1]
+        index = len(self) - 1
+        self._actions.pop()
+        self._linenos.pop()
+        self._frame_ids.pop()
+        if self._var_steps and self._var_steps[-1] == index:
+            self._var_steps.pop()
+            self._var_offsets.pop()
+            start = self._var_offsets[-1]
+            del self._var_names[start:]
+            del self._var_kinds[start:]
+            del self._var_values[start:]
+            del self._var_befores[start:]
+        self._tracebacks.pop(index, None)
+        self._cache.pop(index, None)
+        return diff
+
+    def __len__(self):
+        return len(self._actions)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("trace index out of range")
+
+        try:
+            return self._cache[index]
+        except KeyError:
+            pass
+
+        added = {}
+        updated = {}
+        strings = self._strings
+        var_step = bisect_left(self._var_steps, index)
+        if var_step < len(self._var_steps) and self._var_steps[var_step] == index:
+            deltas = range(
+                self._var_offsets[var_step], self._var_offsets[var_step + 1]
+            )
+        else:
+            deltas = ()
+        for i in deltas:
+            name = strings[self._var_names[i]]
+            if self._var_kinds[i] == _ADDED:
+                added[name] = self._var_values[i]
+            else:
+                updated[name] = VarUpdate(
+                    before=self._var_befores[i], after=self._var_values[i]
+                )
+
+        frame_id = self._frame_ids[index]
+        diff = ExecStateDiff(
+            self._root_func_name,
+            _ACTIONS.get(self._actions[index]),
+            self._frames[frame_id] if frame_id >= 0 else None,
+            self._linenos[index],
+            added or None,
+            updated or None,
+            self._tracebacks.get(index),
+        )
+
+        if len(self._cache) >= 8:
+            self._cache.clear()
+        self._cache[index] = diff
+        return diff
+
+    def string(self, string_id):
+        """ Return the interned string with the given id """
+        return self._strings[string_id]
+
+    def string_id(self, string):
+        """ Return the id of an interned string, or -1 if it is unknown """
+        return self._string_ids.get(string, -1)
+
+    # Copies of the columns for fast scans over the whole trace
+
+    def _per_step(self, per_frame, no_frame):
+        """ Return a column of a per frame value for all steps """
+        # the value of steps without a frame is at index -1
+        per_frame = array("i", per_frame)
+        per_frame.append(no_frame)
+        return array("i", map(per_frame.__getitem__, self._frame_ids))
+
+    @property
+    def actions(self):
+        return array(self._actions.typecode, self._actions)
+
+    @property
+    def linenos(self):
+        return array(self._linenos.typecode, self._linenos)
+
+    @property
+    def func_ids(self):
+        return self._per_step(self._frame_func_ids, self._no_frame_func_id)
+
+    @property
+    def file_ids(self):
+        return self._per_step(self._frame_file_ids, self._no_frame_file_id)
+
+    @property
+    def depths(self):
+        return self._per_step((frame.depth for frame in self._frames), -1)
+
+    @property
+    def tasks(self):
+        """ the asyncio task of each step, None outside of tasks """
+        frames = self._frames
+        return [
+            frames[frame_id].task if frame_id >= 0 else None
+            for frame_id in self._frame_ids
+        ]
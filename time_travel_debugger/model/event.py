@@ -12,13 +12,16 @@ class Event(object):
     """class for storing information about events happening during program
     execution"""
 
-    def __init__(self, type: EventType, id, line, func, file, exec_point):
+    def __init__(
+        self, type: EventType, id, line, func, file, exec_point, depth=0
+    ):
         self.id = id
         self.type = type
         self.line = line
         self.func = func
         self.file = file
         self.exec_point = exec_point
+        self.depth = depth
 
     def __str__(self):
         return f"{os.path.basename(self.file)}:{self.func}:{self.line} -- {self.type}"
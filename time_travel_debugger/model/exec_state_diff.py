@@ -3,7 +3,6 @@ import os
 import inspect
 import collections
 from enum import Enum
-from copy import deepcopy
 
 # named tuple for a variable change
 VarUpdate = collections.namedtuple("VarUpdate", "before after")
@@ -14,38 +13,122 @@ class Action(Enum):
     RET = 2
     UPDATE = 3
     EXCEPTION = 4
+    # a line whose variables were not recorded, because it was not sampled
+    LINE = 5
 
 
 class ExecStateDiff(object):
-    """ Model for saving differences between states of executions """
-
-    def __init__(self, root_func_name):
-        self._function_states = []
-        self._action = None
+    """Model for saving differences between states of executions.
+
+    A diff only stores what happened in this step: the action, the frame of
+    the function it happened in, the line number and the variables that
+    changed. The call stack is not copied into every diff, instead the
+    frames are linked to their callers (see FunctionFrame) and shared by all
+    diffs recorded while they are active.
+    """
+
+    # there is one diff per recorded step, so keep them small
+    __slots__ = (
+        "_root_func_name",
+        "_action",
+        "_frame",
+        "_lineno",
+        "_added_vars",
+        "_updated_vars",
+        "_tb",
+    )
+
+    def __init__(
+        self,
+        root_func_name,
+        action=None,
+        frame=None,
+        lineno=-1,
+        added=None,
+        updated=None,
+        tb=None,
+    ):
         self._root_func_name = root_func_name
+        self._action = action
+        # FunctionFrame of the function this diff belongs to, None if there
+        # is no active function
+        self._frame = frame
+        self._lineno = lineno
+        # Variables that were added to the state in this step
+        self._added_vars = added
+        # Variables that were updated in this step
+        self._updated_vars = updated
+        self._tb = tb
 
-    def call(self, frame):
-        self._function_states.append(FunctionStateDiff(frame))
-        self._action = Action.CALL
-        return self
-
-    def update(self, frame, prev_vars, new_vars):
-        self._function_states[-1].update(frame, prev_vars, new_vars)
-        self._action = Action.UPDATE
-        return self
+    def call(
+        self, frame, file_name=None, params=None, task=None, resumed=False
+    ):
+        """Return the diff for a call of a new function in the given frame.
+        params are the initial variables of the function, defaults to the
+        locals of the frame. task is the name of the asyncio task the
+        function runs in, resumed is True if the frame is a suspended
+        generator or coroutine that continues."""
+        function_frame = FunctionFrame(
+            hash(frame),
+            file_name or inspect.getsourcefile(frame),
+            frame.f_code.co_name,
+            self._frame,
+            self.lineno,
+            task,
+            resumed,
+        )
+        if params is None:
+            params = frame.f_locals.copy()
+        return ExecStateDiff(
+            self._root_func_name,
+            Action.CALL,
+            function_frame,
+            frame.f_lineno,
+            params,
+        )
+
+    def update(self, frame, added, updated):
+        """Return the diff for a new line executed in the current function,
+        which added and updated the given variables"""
+        assert self._frame is not None
+        return ExecStateDiff(
+            self._root_func_name,
+            Action.UPDATE,
+            self._frame,
+            frame.f_lineno,
+            added or None,
+            updated or None,
+        )
+
+    def line(self, frame):
+        """Return the diff for a new line executed in the current function,
+        without recording its variables"""
+        assert self._frame is not None
+        return ExecStateDiff(
+            self._root_func_name, Action.LINE, self._frame, frame.f_lineno
+        )
 
     def ret(self):
-        assert len(self._function_states) > 0
-        self._function_states.pop()
-        self._action = Action.RET
-        return self
+        """ Return the diff for returning from the current function """
+        assert self._frame is not None
+        return ExecStateDiff(
+            self._root_func_name,
+            Action.RET,
+            self._frame.parent,
+            self._frame.caller_lineno,
+        )
 
     def exception(self, tb):
-        self._action = Action.EXCEPTION
-        #  self._exception = exception
-        #  self._value = value
-        self._tb = tb
-        return self
+        """ Return the diff for an exception raised in the current function """
+        return ExecStateDiff(
+            self._root_func_name,
+            Action.EXCEPTION,
+            self._frame,
+            self._lineno,
+            self._added_vars,
+            self._updated_vars,
+            tb,
+        )
 
     def __contains__(self, key):
         return key in self.added or key in self.updated
@@ -59,44 +142,55 @@ class ExecStateDiff(object):
             return None
 
     def __str__(self):
-        return f"{self._action} \t- {self._function_states}\n"
+        return f"{self._action} \t- {self.get_function_states()}\n"
 
     __repr__ = __str__
 
     def get_function_states(self):
-        return self._function_states
+        """Reconstruct the call stack of this diff, starting with the
+        outermost function"""
+        function_states = []
+        frame = self._frame
+        lineno, added, updated = self.lineno, self.added, self.updated
+        while frame is not None:
+            function_states.append(
+                FunctionStateDiff(frame, lineno, added, updated)
+            )
+            # the callers are still at the line where they called us
+            lineno, added, updated = frame.caller_lineno, {}, {}
+            frame = frame.parent
+        function_states.reverse()
+        return function_states
 
     @property
     def action(self):
         return self._action
 
+    @property
+    def frame(self):
+        return self._frame
+
     @property
     def func_name(self):
-        if len(self._function_states) > 0:
-            return self._function_states[-1].func_name
+        if self._frame is not None:
+            return self._frame.func_name
         else:
             return self._root_func_name
 
     @property
     def lineno(self):
-        if len(self._function_states) > 0:
-            return self._function_states[-1].lineno
+        if self._frame is not None:
+            return self._lineno
         else:
             return -1
 
     @property
     def added(self):
-        if len(self._function_states) > 0:
-            return self._function_states[-1].added
-        else:
-            return {}
+        return self._added_vars or {}
 
     @property
     def updated(self):
-        if len(self._function_states) > 0:
-            return self._function_states[-1].updated
-        else:
-            return {}
+        return self._updated_vars or {}
 
     @property
     def changed(self):
@@ -105,49 +199,124 @@ class ExecStateDiff(object):
 
     @property
     def file_name(self):
-        if len(self._function_states) > 0:
-            return self._function_states[-1].file_name
+        if self._frame is not None:
+            return self._frame.file_name
         else:
             return ""
 
+    @property
+    def tb(self):
+        """ the formatted traceback of an exception, None for other diffs """
+        return self._tb
+
+    @property
+    def task(self):
+        """ name of the asyncio task this diff happened in, or None """
+        if self._frame is not None:
+            return self._frame.task
+        else:
+            return None
+
     # the number of nested function calls
     @property
     def depth(self):
-        if len(self._function_states) > 0:
-            return len(self._function_states) - 1
+        if self._frame is not None:
+            return self._frame.depth
         else:
             return -1
 
 
+class FunctionFrame(object):
+    """Entry of the call stack. Each frame points to the frame of its
+    caller, so the call stack prefix is stored only once no matter how many
+    diffs are recorded inside of it."""
+
+    __slots__ = (
+        "_frame",
+        "_file_name",
+        "_func_name",
+        "_parent",
+        "_caller_lineno",
+        "_depth",
+        "_task",
+        "_resumed",
+        "__weakref__",
+    )
+
+    def __init__(
+        self,
+        frame,
+        file_name,
+        func_name,
+        parent,
+        caller_lineno,
+        task=None,
+        resumed=False,
+    ):
+        # Hash of the python frame
+        self._frame = frame
+        self._file_name = file_name
+        self._func_name = func_name
+        self._parent = parent
+        # Line the caller was at when it called this function
+        self._caller_lineno = caller_lineno
+        self._depth = parent.depth + 1 if parent is not None else 0
+        # Name of the asyncio task the function runs in. A coroutine gets a
+        # new frame each time it is resumed, so this is always the task.
+        self._task = task
+        # True if the function continues after it was suspended, then the
+        # frame hash is the one of the frame it was suspended in
+        self._resumed = resumed
+
+    def __str__(self):
+        return f"<{self._func_name} at {os.path.basename(self._file_name)}>"
+
+    __repr__ = __str__
+
+    @property
+    def frame(self):
+        return self._frame
+
+    @property
+    def file_name(self):
+        return self._file_name
+
+    @property
+    def func_name(self):
+        return self._func_name
+
+    @property
+    def parent(self):
+        return self._parent
+
+    @property
+    def caller_lineno(self):
+        return self._caller_lineno
+
+    @property
+    def depth(self):
+        return self._depth
+
+    @property
+    def task(self):
+        return self._task
+
+    @property
+    def resumed(self):
+        return self._resumed
+
+
 class FunctionStateDiff(object):
     """ Model for saving differences between states of executions for one function scope """
 
-    def __init__(self, frame):
-        # Hash of the frame this diff belongs to
-        self._frame = hash(frame)
-        self._file_name = inspect.getsourcefile(frame)
-        self._func_name = frame.f_code.co_name
+    def __init__(self, frame, lineno, added, updated):
+        self._function_frame = frame
         # Line number of the diff
-        self._lineno = frame.f_lineno
-
+        self._lineno = lineno
         # Variables that were added to the state in this step
-        self._added_vars = frame.f_locals.copy()
+        self._added_vars = added
         # Variables that were updated in this step
-        self._updated_vars = {}
-
-    def update(self, frame, prev_vars, changed):
-        self._added_vars = {}
-        self._updated_vars = {}
-        self._lineno = frame.f_lineno
-        for key, value in changed.items():
-            if key in prev_vars:
-                # only push change, if we really changed something
-                if value != prev_vars[key]:
-                    update = VarUpdate(before=prev_vars[key], after=value)
-                    #  if(update.before != update.after):
-                    self._updated_vars[key] = update
-            else:
-                self._added_vars[key] = value
+        self._updated_vars = updated
 
     def __str__(self):
         return f"<lineno: {self.lineno}, added:{self.added}, updated:{self.updated}>"
@@ -157,7 +326,7 @@ class FunctionStateDiff(object):
 
     @property
     def frame(self):
-        return self._frame
+        return self._function_frame.frame
 
     @property
     def lineno(self):
@@ -173,8 +342,8 @@ class FunctionStateDiff(object):
 
     @property
     def file_name(self):
-        return self._file_name
+        return self._function_frame.file_name
 
     @property
     def func_name(self):
-        return self._func_name
+        return self._function_frame.func_name
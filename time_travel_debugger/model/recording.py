@@ -0,0 +1,7 @@
+import collections
+
+# A recorded trace as a Recorder returns it: the diffs and the source map
+# like TimeTravelTracer.get_trace returns them, and the ThreadTraces of the
+# recorded threads and processes (empty if they were not recorded). It can
+# be opened later with TimeTravelCLI().debug(*recording).
+Recording = collections.namedtuple("Recording", "diffs source_map threads")
@@ -0,0 +1,171 @@
+import reprlib
+import sys
+import types
+from copy import deepcopy
+
+from .exec_state_diff import VarUpdate
+
+# Values of these types are immutable, so they can be stored without copying
+# them and compared by value
+SCALAR_TYPES = (
+    type(None),
+    bool,
+    int,
+    float,
+    complex,
+    str,
+    bytes,
+    range,
+    type(Ellipsis),
+)
+
+# Values of these types are stored by reference and only compared by identity
+ATOMIC_TYPES = (
+    type,
+    types.ModuleType,
+    types.FunctionType,
+    types.BuiltinFunctionType,
+)
+
+# Default for the maximum (shallow) size in bytes of a value that is copied
+# into the trace
+DEFAULT_MAX_VALUE_SIZE = 1024 * 1024
+
+_repr = reprlib.Repr()
+_repr.maxstring = _repr.maxother = 200
+
+
+class TruncatedValue(object):
+    """Placeholder for a value that was too large (or could not be copied) to
+    be stored in the trace. Only a shortened repr of the value is kept."""
+
+    def __init__(self, value):
+        self._type_name = type(value).__name__
+        self._repr = _repr.repr(value)
+
+    def __repr__(self):
+        return f"<truncated {self._type_name}: {self._repr}>"
+
+    __str__ = __repr__
+
+    def __eq__(self, other):
+        return isinstance(other, TruncatedValue) and self._repr == other._repr
+
+    def __hash__(self):
+        return hash(self._repr)
+
+
+def value_size(value):
+    """ Cheap estimate of the size of a value, which ignores nested objects """
+    try:
+        return sys.getsizeof(value)
+    except TypeError:
+        return 0
+
+
+def fingerprint(value, max_size=DEFAULT_MAX_VALUE_SIZE):
+    """Compute a cheap fingerprint of a value. If the fingerprint of a
+    variable did not change between two steps, we assume the value did not
+    change either.
+
+    Scalars are fingerprinted by type and value, so changing 1 to True or
+    1.0 is a change as well. Containers and objects are fingerprinted by
+    their identity and the identities of their direct items or attributes,
+    so rebinding or in-place modification of a container is detected, but
+    changes to nested objects are not. Containers that are larger than
+    max_size are only fingerprinted by identity and length.
+    """
+    if type(value) in SCALAR_TYPES:
+        return (type(value), value)
+    if isinstance(value, ATOMIC_TYPES):
+        return (id(value),)
+    try:
+        if value_size(value) > max_size:
+            return (id(value), len(value))
+        if isinstance(value, dict):
+            return (
+                id(value),
+                tuple(map(id, value)),
+                tuple(map(id, value.values())),
+            )
+        if isinstance(value, (list, tuple, set, frozenset, bytearray)):
+            return (id(value), tuple(map(id, value)))
+        if hasattr(value, "__dict__"):
+            return (id(value), tuple(map(id, vars(value).values())))
+    except TypeError:
+        pass
+    return (id(value),)
+
+
+class _CopyMemo(dict):
+    """Memo of deepcopy that refuses to copy objects with a finalizer written
+    in python. Such a finalizer usually releases a resource the object only
+    refers to, e.g. a connection closes its file descriptor, so the copy
+    would release the resource of the original when it is freed."""
+
+    def __setitem__(self, key, value):
+        if isinstance(getattr(type(value), "__del__", None), types.FunctionType):
+            # the copy was just created and has no state yet, which its
+            # finalizer has to cope with anyway, like with a failed __init__
+            raise TypeError(f"cannot copy {type(value).__name__} objects")
+        super().__setitem__(key, value)
+
+
+def snapshot(value, max_size=DEFAULT_MAX_VALUE_SIZE):
+    """Copy a value into the trace, so later modifications of the value do
+    not leak into the recorded state. Values that are larger than max_size
+    or cannot be copied are stored as TruncatedValue."""
+    if type(value) in SCALAR_TYPES or isinstance(value, ATOMIC_TYPES):
+        return value
+    if value_size(value) > max_size:
+        return TruncatedValue(value)
+    try:
+        return deepcopy(value, _CopyMemo())
+    except Exception:
+        return TruncatedValue(value)
+
+
+class LocalsSnapshot(object):
+    """Copy-on-write snapshot of the local variables of one frame.
+
+    Instead of copying all locals on every step, we keep a fingerprint of
+    each variable and only copy the values whose fingerprint changed since
+    the last update.
+    """
+
+    def __init__(self, max_value_size=DEFAULT_MAX_VALUE_SIZE):
+        self._max_value_size = max_value_size
+        self._fingerprints = {}
+        self._values = {}
+
+    def update(self, variables):
+        """Take a new snapshot of the given variables and return the added
+        variables and the updated variables as VarUpdates"""
+        added = {}
+        updated = {}
+
+        # forget deleted variables, so they are added again if they come back
+        for name in [n for n in self._values if n not in variables]:
+            del self._values[name]
+            del self._fingerprints[name]
+
+        for name, value in variables.items():
+            fp = fingerprint(value, self._max_value_size)
+            if name in self._fingerprints:
+                try:
+                    unchanged = fp == self._fingerprints[name]
+                except Exception:
+                    unchanged = False
+                if unchanged:
+                    continue
+                value = snapshot(value, self._max_value_size)
+                updated[name] = VarUpdate(
+                    before=self._values[name], after=value
+                )
+            else:
+                value = snapshot(value, self._max_value_size)
+                added[name] = value
+            self._fingerprints[name] = fp
+            self._values[name] = value
+
+        return added, updated
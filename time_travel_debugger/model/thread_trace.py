@@ -0,0 +1,7 @@
+import collections
+
+# The recorded diffs of one thread. clocks holds the logical time of each
+# diff, which is shared by all threads of a recording, so their steps can be
+# put in the order they happened in. The main thread has id 0, the other
+# threads are numbered in the order they started.
+ThreadTrace = collections.namedtuple("ThreadTrace", "id name diffs clocks")
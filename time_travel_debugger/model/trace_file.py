@@ -0,0 +1,517 @@
+"""Binary on-disk format for recorded traces.
+
+A trace file consists of
+
+    header | payloads | columns | footer | trailer
+
+The payloads hold the variable deltas (and tracebacks) of the steps and are
+written while tracing. When the trace is closed the per-step columns, the
+frame table, the interned string table and the source map are appended.
+The trailer points to the footer, so a reader can memory-map the file and
+access any step without loading the whole trace.
+
+Steps and values are pickled. Unless a trace file is trusted, it is read
+with an unpickler that only creates the classes of the format and common
+builtin values, values of other classes are shown as values that could
+not be loaded.
+"""
+import io
+import mmap
+import os
+import pickle
+import struct
+import sys
+import weakref
+from array import array
+
+from .exec_state_diff import ExecStateDiff, Action, VarUpdate, FunctionFrame
+from .snapshot import TruncatedValue, SCALAR_TYPES
+
+MAGIC = b"TTDTRACE"
+VERSION = 2
+
+_HEADER = struct.Struct("<8sI")
+_TRAILER = struct.Struct("<Q8s")
+
+_ACTIONS = {action.value: action for action in Action}
+
+# per step columns, all stored little endian
+_COLUMNS = (
+    ("actions", "b"),
+    ("linenos", "i"),
+    ("func_ids", "i"),
+    ("file_ids", "i"),
+    ("depths", "i"),
+    ("frame_ids", "i"),
+    ("payload_offsets", "q"),
+    ("payload_lengths", "i"),
+)
+
+# per frame columns
+_FRAME_COLUMNS = (
+    ("hashes", "q"),
+    ("func_ids", "i"),
+    ("file_ids", "i"),
+    ("parents", "i"),
+    ("caller_linenos", "i"),
+    # string id of the asyncio task, -1 outside of tasks
+    ("task_ids", "i"),
+    ("resumed", "b"),
+)
+
+
+# classes an untrusted trace file may contain, creating them runs no code
+# of the file
+_SAFE_CLASSES = {
+    ("builtins", name)
+    for name in (
+        "bool",
+        "bytearray",
+        "bytes",
+        "complex",
+        "dict",
+        "Ellipsis",
+        "float",
+        "frozenset",
+        "int",
+        "list",
+        "NotImplemented",
+        "range",
+        "set",
+        "slice",
+        "str",
+        "tuple",
+        "type",
+    )
+} | {
+    ("collections", "OrderedDict"),
+    ("collections", "deque"),
+    ("collections", "defaultdict"),
+    ("collections", "Counter"),
+    ("datetime", "date"),
+    ("datetime", "datetime"),
+    ("datetime", "time"),
+    ("datetime", "timedelta"),
+    ("datetime", "timezone"),
+    ("decimal", "Decimal"),
+    ("fractions", "Fraction"),
+    (TruncatedValue.__module__, "TruncatedValue"),
+    (__name__, "_Pickled"),
+}
+
+
+class TraceFileError(Exception):
+    pass
+
+
+class _SafeUnpickler(pickle.Unpickler):
+    """ Unpickler that refuses to create classes that are not safe """
+
+    def find_class(self, module, name):
+        if (module, name) not in _SAFE_CLASSES:
+            raise pickle.UnpicklingError(
+                f"{module}.{name} is not loaded from untrusted trace files"
+            )
+        return super().find_class(module, name)
+
+
+def _loads(data, trusted):
+    if trusted:
+        return pickle.loads(data)
+    return _SafeUnpickler(io.BytesIO(data)).load()
+
+
+class _Pickled(object):
+    """A value that is pickled on its own, so a value that cannot be
+    unpickled (e.g. because its class is not importable) does not prevent
+    loading the rest of the step"""
+
+    __slots__ = ("type_name", "data")
+
+    def __init__(self, value):
+        self.type_name = type(value).__qualname__
+        try:
+            self.data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            self.data = pickle.dumps(TruncatedValue(value))
+
+    def __getstate__(self):
+        return (self.type_name, self.data)
+
+    def __setstate__(self, state):
+        self.type_name, self.data = state
+
+    def load(self, trusted):
+        try:
+            return _loads(self.data, trusted)
+        except Exception:
+            return TruncatedValue(f"<{self.type_name} that could not be loaded>")
+
+
+def _pack(value):
+    if type(value) in SCALAR_TYPES:
+        return value
+    return _Pickled(value)
+
+
+def _unpack(value, trusted):
+    if isinstance(value, _Pickled):
+        return value.load(trusted)
+    return value
+
+
+class TraceWriter(object):
+    """Writes the diffs of a trace to a file while they are recorded. It is
+    used like the list of diffs in the tracer."""
+
+    def __init__(self, path):
+        self._path = path
+        self._file = open(path, "wb")
+        self._file.write(_HEADER.pack(MAGIC, VERSION))
+        self._root_func_name = ""
+        self._columns = {name: array(code) for name, code in _COLUMNS}
+        self._frames = {name: array(code) for name, code in _FRAME_COLUMNS}
+        # frames are only looked up while they are active, so we do not need
+        # to keep them alive
+        self._frame_index = weakref.WeakKeyDictionary()
+        self._strings = []
+        self._string_ids = {}
+
+    def _intern(self, string):
+        try:
+            return self._string_ids[string]
+        except KeyError:
+            string_id = len(self._strings)
+            self._strings.append(string)
+            self._string_ids[string] = string_id
+            return string_id
+
+    def _frame_id(self, frame):
+        if frame is None:
+            return -1
+        try:
+            return self._frame_index[frame]
+        except KeyError:
+            pass
+        parent = self._frame_id(frame.parent)
+        frames = self._frames
+        frame_id = len(frames["hashes"])
+        frames["hashes"].append(frame.frame)
+        frames["func_ids"].append(self._intern(frame.func_name))
+        frames["file_ids"].append(self._intern(frame.file_name))
+        frames["parents"].append(parent)
+        frames["caller_linenos"].append(frame.caller_lineno)
+        frames["task_ids"].append(
+            self._intern(frame.task) if frame.task is not None else -1
+        )
+        frames["resumed"].append(frame.resumed)
+        self._frame_index[frame] = frame_id
+        return frame_id
+
+    def append(self, diff):
+        columns = self._columns
+        if not columns["actions"]:
+            self._root_func_name = diff.func_name
+        action = diff.action
+        columns["actions"].append(action.value if action is not None else 0)
+        columns["linenos"].append(diff.lineno)
+        columns["func_ids"].append(self._intern(diff.func_name))
+        columns["file_ids"].append(self._intern(diff.file_name))
+        columns["depths"].append(diff.depth)
+        columns["frame_ids"].append(self._frame_id(diff.frame))
+
+        added = [
+            (self._intern(name), _pack(value))
+            for name, value in diff.added.items()
+        ]
+        updated = [
+            (self._intern(name), _pack(update.before), _pack(update.after))
+            for name, update in diff.updated.items()
+        ]
+        tb = diff._tb if action == Action.EXCEPTION else None
+        if added or updated or tb:
+            payload = pickle.dumps((added, updated, tb), pickle.HIGHEST_PROTOCOL)
+            columns["payload_offsets"].append(self._file.tell())
+            columns["payload_lengths"].append(len(payload))
+            self._file.write(payload)
+        else:
+            columns["payload_offsets"].append(0)
+            columns["payload_lengths"].append(0)
+
+    def pop(self):
+        """Remove the last step. Its payload stays in the file, but is not
+        referenced anymore."""
+        for column in self._columns.values():
+            column.pop()
+
+    def __len__(self):
+        return len(self._columns["actions"])
+
+    def close(self, source_map, clocks=None):
+        """Write the columns and tables and close the file. clocks are the
+        logical times of the steps, if they have one. Returns the path of
+        the trace file."""
+
+        def write_columns(columns):
+            offsets = {}
+            for name, column in columns.items():
+                if sys.byteorder != "little":
+                    column = array(column.typecode, column)
+                    column.byteswap()
+                offsets[name] = (self._file.tell(), len(column))
+                column.tofile(self._file)
+            return offsets
+
+        footer = {
+            "root_func_name": self._root_func_name,
+            "columns": write_columns(self._columns),
+            "frames": write_columns(self._frames),
+            "strings": self._strings,
+            "source_map": source_map,
+            "clocks": (
+                write_columns({"clocks": clocks})["clocks"]
+                if clocks is not None
+                else None
+            ),
+        }
+        footer_offset = self._file.tell()
+        pickle.dump(footer, self._file, pickle.HIGHEST_PROTOCOL)
+        self._file.write(_TRAILER.pack(footer_offset, MAGIC))
+        self._file.close()
+        return self._path
+
+
+class MappedTrace(object):
+    """Read-only trace that is backed by a memory-mapped trace file. It
+    behaves like the list of diffs returned by the tracer, but only the
+    steps that are accessed are loaded.
+
+    Only trusted files can contain values of any class, because loading
+    them can run any code. A file that is not trusted, e.g. one that comes
+    from another machine, only contains builtin values. The file stays open
+    until close is called, or use the trace as context manager."""
+
+    def __init__(self, path, trusted=False):
+        self._path = path
+        self._trusted = trusted
+        with open(path, "rb") as f:
+            # a process that was killed while recording leaves an empty or
+            # truncated file, which can't be mapped or has no trailer
+            size = os.fstat(f.fileno()).st_size
+            if size < _HEADER.size:
+                raise TraceFileError(f"{path} is incomplete")
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version = _HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise TraceFileError(f"{path} is not a trace file")
+        if version != VERSION:
+            raise TraceFileError(f"unsupported trace file version {version}")
+        if size < _HEADER.size + _TRAILER.size:
+            raise TraceFileError(f"{path} is incomplete")
+        footer_offset, magic = _TRAILER.unpack_from(
+            self._mmap, size - _TRAILER.size
+        )
+        if magic != MAGIC or not _HEADER.size <= footer_offset < size:
+            raise TraceFileError(f"{path} is incomplete")
+
+        try:
+            footer = _loads(
+                self._mmap[footer_offset : -_TRAILER.size], trusted
+            )
+        except Exception:
+            raise TraceFileError(f"{path} is corrupt")
+        self._root_func_name = footer["root_func_name"]
+        self._strings = footer["strings"]
+        self._string_ids = {s: i for i, s in enumerate(self._strings)}
+        self._source_map = footer["source_map"]
+        self._columns = self._map_columns(_COLUMNS, footer["columns"])
+        self._frame_columns = self._map_columns(_FRAME_COLUMNS, footer["frames"])
+        self._clocks = None
+        # traces of version 2 written before steps had clocks have none
+        if footer.get("clocks") is not None:
+            self._clocks = self._map_columns(
+                (("clocks", "q"),), {"clocks": footer["clocks"]}
+            )["clocks"]
+        self._frame_cache = {}
+        self._cache = {}
+
+    def _map_columns(self, layout, offsets):
+        columns = {}
+        view = memoryview(self._mmap)
+        for name, code in layout:
+            offset, length = offsets[name]
+            size = array(code).itemsize
+            data = view[offset : offset + length * size]
+            if sys.byteorder == "little":
+                columns[name] = data.cast(code)
+            else:
+                column = array(code, data.tobytes())
+                column.byteswap()
+                # read-only like the mapped columns
+                columns[name] = memoryview(column.tobytes()).cast(code)
+        return columns
+
+    def close(self):
+        """ Unmap the trace file, no steps can be accessed afterwards """
+        for columns in (self._columns, self._frame_columns):
+            for column in columns.values():
+                column.release()
+        if self._clocks is not None:
+            self._clocks.release()
+        self._cache.clear()
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def source_map(self):
+        return self._source_map
+
+    @property
+    def clocks(self):
+        """ logical time of each step, None if the steps have none """
+        return self._clocks
+
+    def _string(self, string_id):
+        return self._strings[string_id] if string_id >= 0 else None
+
+    def _frame(self, frame_id):
+        if frame_id < 0:
+            return None
+        try:
+            return self._frame_cache[frame_id]
+        except KeyError:
+            pass
+        frames = self._frame_columns
+        frame = FunctionFrame(
+            frames["hashes"][frame_id],
+            self._strings[frames["file_ids"][frame_id]],
+            self._strings[frames["func_ids"][frame_id]],
+            self._frame(frames["parents"][frame_id]),
+            frames["caller_linenos"][frame_id],
+            self._string(frames["task_ids"][frame_id]),
+            bool(frames["resumed"][frame_id]),
+        )
+        self._frame_cache[frame_id] = frame
+        return frame
+
+    def __len__(self):
+        return len(self._columns["actions"])
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("trace index out of range")
+
+        try:
+            return self._cache[index]
+        except KeyError:
+            pass
+
+        columns = self._columns
+        added = updated = tb = None
+        length = columns["payload_lengths"][index]
+        if length:
+            offset = columns["payload_offsets"][index]
+            trusted = self._trusted
+            try:
+                raw_added, raw_updated, tb = _loads(
+                    self._mmap[offset : offset + length], trusted
+                )
+            except Exception:
+                raise TraceFileError(f"step {index} of {self._path} is corrupt")
+            strings = self._strings
+            added = {
+                strings[name]: _unpack(value, trusted)
+                for name, value in raw_added
+            }
+            updated = {
+                strings[name]: VarUpdate(
+                    _unpack(before, trusted), _unpack(after, trusted)
+                )
+                for name, before, after in raw_updated
+            }
+
+        diff = ExecStateDiff(
+            self._root_func_name,
+            _ACTIONS.get(columns["actions"][index]),
+            self._frame(columns["frame_ids"][index]),
+            columns["linenos"][index],
+            added or None,
+            updated or None,
+            tb,
+        )
+
+        if len(self._cache) >= 8:
+            self._cache.clear()
+        self._cache[index] = diff
+        return diff
+
+    def string(self, string_id):
+        """ Return the interned string with the given id """
+        return self._strings[string_id]
+
+    def string_id(self, string):
+        """ Return the id of an interned string, or -1 if it is unknown """
+        return self._string_ids.get(string, -1)
+
+    # Read-only access to the columns for fast scans over the whole trace
+
+    @property
+    def actions(self):
+        return self._columns["actions"]
+
+    @property
+    def linenos(self):
+        return self._columns["linenos"]
+
+    @property
+    def func_ids(self):
+        return self._columns["func_ids"]
+
+    @property
+    def file_ids(self):
+        return self._columns["file_ids"]
+
+    @property
+    def depths(self):
+        return self._columns["depths"]
+
+    @property
+    def tasks(self):
+        """ the asyncio task of each step, None outside of tasks """
+        task_ids = self._frame_columns["task_ids"]
+        return [
+            self._string(task_ids[frame_id]) if frame_id >= 0 else None
+            for frame_id in self._columns["frame_ids"]
+        ]
+
+
+def save_trace(path, diffs, source_map):
+    """ Write a recorded trace to the given file """
+    writer = TraceWriter(path)
+    for diff in diffs:
+        writer.append(diff)
+    return writer.close(source_map)
+
+
+def load_trace(path, trusted=False):
+    """Open a trace file, returns the diffs and the source map like
+    TimeTravelTracer.get_trace. Values of classes that are not builtin are
+    only loaded from trusted files, see MappedTrace."""
+    trace = MappedTrace(path, trusted)
+    return trace, trace.source_map
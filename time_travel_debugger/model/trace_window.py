@@ -0,0 +1,23 @@
+class TraceWindow(list):
+    """The last steps of a recording, as kept by a flight recorder. The
+    steps before them were dropped, base holds the scopes of the active
+    functions they led to, which is the state at the first step. The first
+    step itself is the last one that was dropped, the debugger starts at the
+    one after it like it does for a complete trace. point is the index of
+    the step of interest, where a start trigger fired, by default the last
+    one."""
+
+    def __init__(self, diffs, base, point=None):
+        super().__init__(diffs)
+        self._base = base
+        self._point = point
+
+    @property
+    def base(self):
+        return self._base
+
+    @property
+    def point(self):
+        if self._point is None:
+            return len(self) - 1
+        return min(self._point, len(self) - 1)
@@ -0,0 +1,90 @@
+from fnmatch import fnmatch
+
+
+class Trigger(object):
+    """Condition that starts or stops the recording of a tracer (see the
+    start_at and stop_at options of TimeTravelTracer). The tracer asks the
+    trigger for every event it records, with the same arguments settrace
+    passes to a trace function."""
+
+    def fires(self, frame, event, arg):
+        """ Return whether the trigger fires at the given event """
+        return False
+
+
+class FunctionTrigger(Trigger):
+    """Fires when a function is entered whose name matches the glob pattern,
+    e.g. "parse_*" """
+
+    def __init__(self, pattern):
+        self._pattern = pattern
+
+    def fires(self, frame, event, arg):
+        return event == "call" and fnmatch(frame.f_code.co_name, self._pattern)
+
+    @property
+    def pattern(self):
+        return self._pattern
+
+    def __repr__(self):
+        return f"FunctionTrigger({self._pattern!r})"
+
+
+class ConditionTrigger(Trigger):
+    """Fires at the first line at which the condition is true. The condition
+    is either an expression like "len(items) > 100", which is evaluated with
+    the variables of the function the line is in, or a function that is
+    called with these variables. Errors count as false, like the ones of
+    conditional breakpoints."""
+
+    def __init__(self, condition):
+        self._condition = condition
+        # compile the condition only once, raises a SyntaxError if the
+        # condition is invalid
+        self._code = (
+            compile(condition, "<trigger>", "eval")
+            if isinstance(condition, str)
+            else None
+        )
+
+    def fires(self, frame, event, arg):
+        if event != "line":
+            return False
+        try:
+            if self._code is not None:
+                return bool(eval(self._code, frame.f_globals, frame.f_locals))
+            return bool(self._condition(frame.f_locals))
+        except Exception:
+            return False
+
+    @property
+    def condition(self):
+        return self._condition
+
+    def __repr__(self):
+        return f"ConditionTrigger({self._condition!r})"
+
+
+class ExceptionTrigger(Trigger):
+    """Fires when an exception of the given type is raised, where it is
+    raised"""
+
+    def __init__(self, exception_type=Exception):
+        self._exception_type = exception_type
+
+    def fires(self, frame, event, arg):
+        # the exception is reported again by every function it passes
+        # through, it only fires where it was raised
+        return (
+            event == "exception"
+            and isinstance(arg[1], self._exception_type)
+            and arg[2] is not None
+            and arg[2].tb_next is None
+        )
+
+    @property
+    def exception_type(self):
+        return self._exception_type
+
+    def __repr__(self):
+        return f"ExceptionTrigger({self._exception_type.__name__})"
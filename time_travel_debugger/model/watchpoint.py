@@ -1,26 +1,54 @@
+def values_differ(a, b):
+    """Compare two values of a watched expression, values that can't be
+    compared (e.g. arrays with an ambiguous truth value) differ"""
+    try:
+        return bool(a != b)
+    except Exception:
+        return True
+
+
 class Watchpoint(object):
     def __init__(self, id, expression, initial=None):
         self._id = id
         self._last_value = initial
         self._current_value = initial
         self._expression = expression
+        # compile the expression only once, raises a SyntaxError if the
+        # expression is invalid
+        self._code = compile(expression, "<watchpoint>", "eval")
+        # the state the current value has to be evaluated in, the expression
+        # is only evaluated when the value is needed, e.g. when it is shown
+        self._state = None
+        # sorted exec points at which the value changes, if it was computed
+        # (see TimeTravelDebugger.compute_timeline)
+        self.timeline = None
 
     def init(self, state):
-        self._current_value = self._last_value = self._eval(state)
+        self._current_value = self._last_value = self.evaluate(state)
+        self._state = None
 
-    def _eval(self, state):
+    def evaluate(self, state):
+        """ Return the value of the expression in the given state """
         try:
-            return eval(self._expression, state)
-        except:
+            return eval(self._code, state)
+        except Exception:
             return None
 
     def update(self, state):
-        value = self._eval(state)
-        self._last_value = self._current_value
-        self._current_value = value
+        """The debugger moved to the given state. The value is evaluated in it
+        when it is needed, the last value is the one that was needed before
+        that."""
+        self._state = state
+
+    def _evaluate_pending(self):
+        if self._state is not None:
+            self._last_value = self._current_value
+            self._current_value = self.evaluate(self._state)
+            self._state = None
 
     def has_changed(self):
-        return self._current_value != self._last_value
+        self._evaluate_pending()
+        return values_differ(self._current_value, self._last_value)
 
     @property
     def id(self):
@@ -28,10 +56,12 @@ class Watchpoint(object):
 
     @property
     def last_value(self):
+        self._evaluate_pending()
         return self._last_value
 
     @property
     def current_value(self):
+        self._evaluate_pending()
         return self._current_value
 
     @property
@@ -40,8 +70,8 @@ class Watchpoint(object):
 
     def __iter__(self):
         return iter(
-            (str(self._id), self._expression, repr(self._current_value))
+            (str(self._id), self._expression, repr(self.current_value))
         )
 
     def __str__(self):
-        return f"{repr(self.expression)}: {repr(self._last_value)} -> {repr(self._current_value)}"
+        return f"{repr(self.expression)}: {repr(self.last_value)} -> {repr(self.current_value)}"
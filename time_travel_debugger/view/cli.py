@@ -14,6 +14,8 @@ from ..domain.debugger import TimeTravelDebugger, Direction
 from ..domain.tracer import TimeTravelTracer
 from ..domain.searchengine import SearchEngine, EventType
 from ..model.exec_state_diff import Action
+from ..model.trace_file import load_trace
+from ..model.trace_window import TraceWindow
 from .completer import CLICompleter
 
 _next_inputs = list()
@@ -36,19 +38,26 @@ class TimeTravelCLI(object):
         "reverse",
         "until",
         "backuntil",
+        "untilchange",
+        "backuntilchange",
         "step",
         "start",
         "up",
         "down",
+        "origin",
+        "thread",
     ]
 
     BOLD = "\033[1m"
     END = "\033[0m"
 
-    def __init__(self, file=sys.stdout):
+    # number of search results printed at once
+    SEARCH_PAGE_SIZE = 20
+
+    def __init__(self, file=sys.stdout, **tracer_options):
         # Stores the respective line number and variable changes for each
-        # exection step
-        self._tracer = TimeTravelTracer()
+        # exection step, tracer_options are passed on to the tracer
+        self._tracer = TimeTravelTracer(**tracer_options)
         self._current_state = None
         self._debugger = None
         self._file = file
@@ -56,19 +65,49 @@ class TimeTravelCLI(object):
         self._draw_update = True
         self._lexer = lexers.get_lexer_by_name("Python")
         self._quit = False
+        # results of the last search and how many of them we printed
+        self._search_results = None
+        self._search_offset = 0
 
     def __enter__(self, *args, **kwargs):
         self._tracer.set_trace()
 
     def __exit__(self, *args, **kwargs):
         diffs, source_map = self._tracer.get_trace()
+        self.debug(diffs, source_map, self._tracer.threads)
+
+    def open(self, path, trusted=False):
+        """Debug a trace that was saved to a trace file. Only trusted files
+        can contain values of any class, since loading them can run any
+        code."""
+        self.debug(*load_trace(path, trusted))
+
+    def dump(self):
+        """Start an interactive session on the steps a flight recorder (see
+        the keep_last and keep_size options) kept so far. The recording goes
+        on when the session ends."""
+        self._tracer.pause()
+        try:
+            self.debug(*self._tracer.dump())
+        finally:
+            self._tracer.resume()
+
+    def debug(self, diffs, source_map, threads=None):
+        """Start an interactive session on a recorded trace, and the traces
+        of the other threads and processes if they were recorded"""
         self._completer = CLICompleter(self.commands())
         readline.set_completer(self._completer.complete)
         readline.parse_and_bind("tab: complete")
         search_engine = SearchEngine()
         self._debugger = TimeTravelDebugger(diffs, source_map, self.update,
-            search_engine)
-        self._debugger.step_forward()
+            search_engine, threads)
+        if isinstance(diffs, TraceWindow):
+            # the steps of a flight recorder lead up to the point of
+            # interest, the end or where the start trigger fired
+            self._debugger.step_to_index(diffs.point, ignore_breakpoints=True)
+        else:
+            self._debugger.step_forward()
+        self._quit = False
         self.execute()
 
     def get_input(self):
@@ -222,6 +261,11 @@ class TimeTravelCLI(object):
 
         # Shorthand such that the following code is not as lengthy
         curr_vars = self._current_state
+        if self._debugger.state_is_approximate:
+            self.log(
+                "(approximate: variables were not sampled at this line, "
+                "showing the last sampled values)"
+            )
         if curr_vars:
             if not arg:
                 self.log(
@@ -399,21 +443,101 @@ class TimeTravelCLI(object):
         self._debugger.reverse()
 
     def search_command(self, arg=""):
-        """ {event_type query} - Search for specific events, like variable changes and breakpoint hits """
+        """ {event_type query} - Search for specific events, like variable changes and breakpoint hits. Without arguments, print the next results of the last search """
         if arg:
             try:
                 event_type, query = arg.split(" ",1)
-                try:
-                    results = self._debugger.search(event_type,query)
-                    if results == None:
-                        print("Wrong search criteria")
-                    pprint(results)
-                except Exception as err:
-                    print(err)
-
             except ValueError:
                 print("Wrong number of arguments!")
+                return
+            try:
+                self._search_results = self._debugger.search(event_type,query)
+            except Exception as err:
+                print(err)
+                return
+            self._search_offset = 0
+        elif self._search_results is None:
+            print("Nothing searched yet")
+            return
 
+        results = self._search_results.page(
+            self._search_offset, self.SEARCH_PAGE_SIZE
+        )
+        if not results:
+            print("No more results" if self._search_offset else "No results")
+            return
+        pprint(results)
+        start = self._search_offset + 1
+        self._search_offset += len(results)
+        # the total is only known once all candidates were checked, which
+        # the next pages may not need
+        search_results = self._search_results
+        if search_results.complete:
+            total = search_results.found
+            more = self._search_offset < total
+        else:
+            total = f"{search_results.found}+"
+            more = True
+        print(f"Results {start}-{self._search_offset} of {total}")
+        if more:
+            # pressing enter prints the next results
+            print("Press enter for more results")
+            self._last_command = "search"
+
+    def origin_command(self, arg=""):
+        """ {var [value]} - Go to the change at which the variable first took the value, or without a value to its last change before the current step """
+        var_name, _, value = arg.partition(" ")
+        if not var_name:
+            self.log("Origin needs a variable")
+            return
+        if value:
+            try:
+                value = eval(value, globals(), self._current_state)
+            except Exception as err:
+                self.log(f"{err.__class__.__name__}: {err}")
+                return
+            event = self._debugger.first_change_to(var_name, value)
+        else:
+            event = self._debugger.last_change(var_name)
+        if event is None:
+            self.log(f"No such change of {var_name}")
+            return
+        self._debugger.step_to_index(event.exec_point, ignore_breakpoints=True)
+
+    def thread_command(self, arg=""):
+        """ {[id]} - Switch to the thread or process with the given id at the current point in time, without an id list the recorded threads and processes """
+        threads = self._debugger.threads
+        if not threads:
+            self.log("Threads and processes were not recorded")
+            return
+        if not arg:
+            for thread in threads:
+                current = "*" if thread.id == self._debugger.thread_id else " "
+                self.log(
+                    f"{current} {thread.id}: {thread.name} "
+                    f"({len(thread.diffs)} steps)"
+                )
+            return
+        try:
+            thread_id = int(arg)
+        except ValueError:
+            self.log(f"Invalid thread id: '{arg}'")
+            return
+        if thread_id not in [thread.id for thread in threads]:
+            self.log(f"Thread with id {arg} does not exist.")
+            return
+        self._debugger.switch_thread(thread_id)
+
+    def task_command(self, arg=""):
+        """ {[on|off]} - Let next and finish skip the steps of other asyncio tasks, without an argument print the current task """
+        if arg in ("on", "off"):
+            self._debugger.follow_task = arg == "on"
+        elif arg:
+            self.log(f"Invalid argument: '{arg}', use on or off")
+            return
+        task = self._debugger.task or "no task"
+        mode = "on" if self._debugger.follow_task else "off"
+        self.log(f"Current task: {task}, stepping within the task is {mode}")
 
     def _print_callstack(self, stack):
         for (frame, (func, file)) in reversed(list(enumerate(stack, start=1))):
@@ -446,7 +570,11 @@ class TimeTravelCLI(object):
             for wp in self._debugger.watchpoints:
                 print(table_template.format(*wp))
         else:
-            res = self._debugger.add_watchpoint(arg)
+            try:
+                res = self._debugger.add_watchpoint(arg)
+            except SyntaxError as e:
+                print(f"Invalid expression: {e.msg}")
+                return
             if not res:
                 print("Could not add watchpoint.")
             else:
@@ -459,6 +587,35 @@ class TimeTravelCLI(object):
         else:
             print(f"Successfully removed watchpoint {arg}.")
 
+    def timeline_command(self, arg=""):
+        """ {id} - Compute at which steps the value of a watchpoint changes, so untilchange goes there directly """
+        try:
+            wp = self._debugger.compute_timeline(int(arg))
+        except ValueError:
+            print(f"Invalid watchpoint id: '{arg}'")
+            return
+        if wp is None:
+            print(f"Watchpoint with id {arg} does not exist.")
+        else:
+            print(f"The value of {wp.expression} changes {len(wp.timeline)} times.")
+
+    def untilchange_command(self, arg=""):
+        """ {id} - Execute forward until the value of a watchpoint changes """
+        self._until_change(arg, Direction.FORWARD)
+
+    def backuntilchange_command(self, arg=""):
+        """ {id} - Execute backward until the value of a watchpoint changes """
+        self._until_change(arg, Direction.BACKWARD)
+
+    def _until_change(self, arg, direction):
+        try:
+            id = int(arg)
+        except ValueError:
+            print(f"Invalid watchpoint id: '{arg}'")
+            return
+        if not self._debugger.until_change(id, direction):
+            print(f"Watchpoint with id {arg} does not exist.")
+
     def break_command(self, arg=""):
         """ Insert a breakpoint at the given location """
         # Find out which type of breakpoint we want to insert
@@ -510,7 +667,10 @@ class TimeTravelCLI(object):
         except ValueError:
             self.log("Cond needs a line number and a condition")
             return
-        self._debugger.add_breakpoint(lineno=lineno, cond=condition)
+        try:
+            self._debugger.add_breakpoint(lineno=lineno, cond=condition)
+        except SyntaxError as e:
+            self.log(f"Invalid condition: {e.msg}")
 
     def quit_command(self, arg=""):
         self._quit = True
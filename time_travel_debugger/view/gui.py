@@ -28,6 +28,8 @@ from ..domain.debugger import TimeTravelDebugger
 from ..domain.tracer import TimeTravelTracer
 from ..domain.searchengine import SearchEngine
 from ..model.breakpoint import BPType
+from ..model.trace_file import load_trace
+from ..model.trace_window import TraceWindow
 
 here = os.path.dirname(__file__)
 root = os.path.abspath(os.path.join(here, "../../"))
@@ -36,6 +38,9 @@ cssfile = open(os.path.join(root, "codestyle.css")).read()
 
 class GUI(object):
 
+    # number of search results shown at once
+    SEARCH_PAGE_SIZE = 50
+
     _BUTTONS = {
         "backstep": {
             "icon": "step-backward",
@@ -71,12 +76,14 @@ class GUI(object):
         },
     }
 
-    def __init__(self):
+    def __init__(self, **tracer_options):
         # Stores the respective line number and variable changes for each
-        # exection step
-        self._tracer = TimeTravelTracer()
+        # exection step, tracer_options are passed on to the tracer
+        self._tracer = TimeTravelTracer(**tracer_options)
         self._current_state = None
         self._debugger = None
+        # results of the last search
+        self._search_events = None
 
         self._code_output = HTML()
         self._var_output = Output()
@@ -280,11 +287,35 @@ class GUI(object):
 
     def __exit__(self, *args, **kwargs):
         diffs, source_map = self._tracer.get_trace()
+        self.debug(diffs, source_map)
+
+    def open(self, path, trusted=False):
+        """Debug a trace that was saved to a trace file. Only trusted files
+        can contain values of any class, since loading them can run any
+        code."""
+        self.debug(*load_trace(path, trusted))
+
+    def dump(self):
+        """Show the debugger for the steps a flight recorder (see the
+        keep_last and keep_size options) kept so far, while the recording
+        goes on"""
+        self._tracer.pause()
+        try:
+            self.debug(*self._tracer.dump())
+        finally:
+            self._tracer.resume()
+
+    def debug(self, diffs, source_map):
+        """ Show the debugger for a recorded trace """
         search_engine = SearchEngine()
         self._debugger = TimeTravelDebugger(
             diffs, source_map, self.update, search_engine
         )
         self._debugger.start_debugger()
+        if isinstance(diffs, TraceWindow):
+            # the steps of a flight recorder lead up to the point of
+            # interest, the end or where the start trigger fired
+            self._debugger.step_to_index(diffs.point, ignore_breakpoints=True)
         self._diff_slider.max = len(diffs) - 1
         self._function_dropdown.options = self._debugger.source_map.keys()
 
@@ -350,7 +381,13 @@ class GUI(object):
         header = "| Variable | Type | Value |"
         split = "| --- | --- | --- |"
 
-        variable_table = header + "\n" + split + "\n"
+        variable_table = ""
+        if self._debugger.state_is_approximate:
+            variable_table += (
+                "*Approximate: variables were not sampled at this line, "
+                "showing the last sampled values*\n\n"
+            )
+        variable_table += header + "\n" + split + "\n"
         variable_table += "\n".join(
             template.format(var, type(curr_vars[var]), curr_vars[var])
             for var in curr_vars
@@ -448,7 +485,10 @@ class GUI(object):
     def watch_command(self, change):
         """ Insert a watchpoint """
         arg = self._watchpoint_input.value
-        self._debugger.add_watchpoint(expression=arg)
+        try:
+            self._debugger.add_watchpoint(expression=arg)
+        except SyntaxError:
+            self._watchpoint_input.placeholder = "Invalid expression!"
         self._watchpoint_input.value = ""
         self.update()
 
@@ -549,25 +589,19 @@ class GUI(object):
                 self._line_input.placeholder = "Please enter a valid number!"
                 return
 
+        if type == "Function":
+            self._debugger.add_breakpoint(funcname=function)
+        if type == "Line":
+            self._debugger.add_breakpoint(lineno=line)
         if type == "Conditional":
             try:
-                eval(condition)
+                self._debugger.add_breakpoint(lineno=line, cond=condition)
             except SyntaxError:
                 if self._condition_input.value:
                     self._condition_input.placeholder = "Invalid expression!"
                 self._condition_input.value = ""
                 return
 
-            except NameError:
-                pass
-
-        if type == "Function":
-            self._debugger.add_breakpoint(funcname=function)
-        if type == "Line":
-            self._debugger.add_breakpoint(lineno=line)
-        if type == "Conditional":
-            self._debugger.add_breakpoint(lineno=line, cond=condition)
-
         self.update()
 
     def _handle_breakpoint_type(self, change):
@@ -579,20 +613,43 @@ class GUI(object):
         try:
             input = change["new"]
             event_type, query = input.split(" ", 1)
-            events = self._debugger.search(event_type, query)
+            self._search_events = self._debugger.search(event_type, query)
         except:
             return
 
         with self._search_results:
             clear_output()
+        self._show_search_page(0)
+
+    def _show_search_page(self, offset):
+        """ append the search results of the page starting at offset """
+        events = self._search_events.page(offset, self.SEARCH_PAGE_SIZE)
+        with self._search_results:
             for event in events:
                 goto = Button(
                     icon="angle-right",
                     layout=Layout(width="30px", height="30px"),
                 )
                 goto.on_click(
-                    lambda change: self._debugger.step_to_index(
+                    lambda change, event=event: self._debugger.step_to_index(
                         event.exec_point, ignore_breakpoints=True
                     )
                 )
                 display(HBox([goto, Label(value=str(event))]))
+
+            end = offset + len(events)
+            # the total is only known once all candidates were checked
+            complete = self._search_events.complete
+            total = self._search_events.found
+            if end < total or not complete:
+                known = "" if complete else "+"
+                more = Button(
+                    description=f"Show more ({end} of {total}{known})"
+                )
+
+                def show_more(change):
+                    more.close()
+                    self._show_search_page(end)
+
+                more.on_click(show_more)
+                display(more)